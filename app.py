@@ -4,11 +4,22 @@ Protein Resequencer - Chambre de Fermentation Contrôlée
 Contrôleur principal v4 - GPIO relais, HACCP frigo
 """
 
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, Response, g, render_template, jsonify, request
 from datetime import datetime, timedelta
+from array import array
+from bisect import bisect_left, bisect_right, insort
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import base64
+import csv
+import hashlib
+import io
 import json
+import math
+import sqlite3
 import os
+import sys
 import threading
 import time
 
@@ -28,37 +39,336 @@ SENSOR_MAP = {
     "28-00000071b49c": "t2",  # chambre
     "28-00000073a825": "t3",  # frigo HACCP
 }
-HACCP_LOG_FILE = "haccp.json"
+# Dossier des données (batchs, HACCP, réglages…), le dossier courant par défaut ; PR_DATA_DIR
+# permet de faire tourner plusieurs chambres sur une même machine (voir coordinator.py)
+DATA_DIR = os.environ.get("PR_DATA_DIR", ".")
+os.makedirs(DATA_DIR, exist_ok=True)
+
+def data_path(name):
+    return os.path.join(DATA_DIR, name)
+
+HACCP_LOG_FILE = data_path("haccp.json")  # ancien format, migré au premier démarrage
+HACCP_DIR = data_path("haccp")            # un fichier JSON Lines par mois
+HACCP_RETENTION_DAYS = 90
 HACCP_INTERVAL = 900  # 15 min entre chaque relevé
 
+# Période du cycle acquisition/régulation (secondes), indépendante des clients HTTP
+CONTROL_PERIOD = float(os.environ.get("PR_CONTROL_PERIOD", "2"))
+
+# Instrumentation, exposée au format texte Prometheus sur /metrics
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # dernière case : au-delà du plus grand seuil
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """Compteurs, jauges et histogrammes étiquetés. Une mise à jour coûte quelques µs :
+    on peut instrumenter la boucle de régulation et chaque requête."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.meta = {}    # nom -> (type, aide)
+        self.values = {}  # (nom, étiquettes) -> nombre ou Histogram
+
+    def describe(self, name, kind, text):
+        self.meta[name] = (kind, text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.values.get(key)
+            if hist is None:
+                hist = self.values[key] = Histogram(buckets)
+            hist.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def render(self):
+        with self.lock:
+            entries = []
+            for (name, labels), value in sorted(self.values.items(), key=lambda kv: kv[0]):
+                if isinstance(value, Histogram):
+                    value = (value.buckets, list(value.counts), value.sum, value.count)
+                entries.append((name, labels, value))
+        lines = []
+        current = None
+        for name, labels, value in entries:
+            if name != current:
+                kind, text = self.meta.get(name, ("untyped", ""))
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+                current = name
+            if isinstance(value, tuple):
+                buckets, counts, total, count = value
+                cumulative = 0
+                for bound, n in zip(list(buckets) + ["+Inf"], counts):
+                    cumulative += n
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {total:.6f}")
+                lines.append(f"{name}_count{format_labels(labels)} {count}")
+            else:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+metrics = Metrics()
+metrics.describe("pr_sensor_read_seconds", "histogram", "Durée de lecture par capteur")
+metrics.describe("pr_sensor_read_failures_total", "counter", "Lectures de capteur échouées")
+metrics.describe("pr_control_cycle_seconds", "histogram", "Durée de travail d'un cycle acquisition/régulation")
+metrics.describe("pr_control_period_seconds", "gauge", "Dernier intervalle mesuré entre deux cycles")
+metrics.describe("pr_control_jitter_seconds", "histogram", "Écart entre l'intervalle mesuré et PR_CONTROL_PERIOD")
+metrics.describe("pr_control_overruns_total", "counter", "Cycles terminés après l'échéance du suivant")
+metrics.describe("pr_haccp_log_seconds", "histogram", "Durée d'un relevé HACCP")
+metrics.describe("pr_file_write_seconds", "histogram", "Durée d'écriture synchronisée par fichier")
+metrics.describe("pr_file_size_bytes", "gauge", "Taille des fichiers de données")
+metrics.describe("pr_db_write_seconds", "histogram", "Durée d'écriture SQLite")
+metrics.describe("pr_analytics_seconds", "histogram", "Durée de calcul de l'analyse d'un batch")
+metrics.describe("pr_http_request_seconds", "histogram", "Durée de traitement par route")
+metrics.describe("pr_http_requests_total", "counter", "Requêtes par route et code de retour")
+metrics.describe("pr_process_resident_memory_bytes", "gauge", "Mémoire résidente du processus")
+metrics.describe("pr_process_threads", "gauge", "Threads Python actifs")
+
+class SamplingProfiler:
+    """Profileur statistique : relève la pile de chaque thread toutes les `interval` secondes.
+    Coût négligeable à 10 ms ; résultat en piles repliées (flamegraph.pl, speedscope)."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.samples = 0
+        self.thread = None
+        self.stopped = None  # Event propre à chaque démarrage : un ancien thread ne repart jamais
+
+    @property
+    def running(self):
+        return self.stopped is not None and not self.stopped.is_set()
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return
+            self.stopped = threading.Event()
+            self.thread = threading.Thread(target=self.run, args=(self.stopped,), name="profiler", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            if self.stopped is not None:
+                self.stopped.set()
+
+    def reset(self):
+        with self.lock:
+            self.counts = {}
+            self.samples = 0
+
+    def run(self, stopped):
+        own = threading.get_ident()
+        names = {}
+        while not stopped.is_set():
+            for t in threading.enumerate():
+                names[t.ident] = t.name
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks.append(";".join(reversed(stack)))
+            with self.lock:
+                for stack in stacks:
+                    self.counts[stack] = self.counts.get(stack, 0) + 1
+                self.samples += 1
+            stopped.wait(self.interval)
+
+    def collapsed(self):
+        with self.lock:
+            items = sorted(self.counts.items(), key=lambda kv: -kv[1])
+        return "".join(f"{stack} {count}\n" for stack, count in items)
+
+profiler = SamplingProfiler()
+
+# Matériel simulé (PR_FAKE_HARDWARE=1, voir hwsim.py) : développement et bancs d'essai sans Pi
+fake_hardware = None
+if os.environ.get("PR_FAKE_HARDWARE") == "1":
+    import hwsim
+    fake_hardware = hwsim.FakeHardware.from_env()
+    print(f"Matériel simulé (1-Wire dans {fake_hardware.w1_root})")
+
 # Init GPIO
 gpio_available = False
 relay_lines = {}
-try:
-    from gpiozero import OutputDevice
-    for name, pin in RELAY_PINS.items():
-        relay_lines[name] = OutputDevice(pin, active_high=True, initial_value=True)
+if fake_hardware is not None:
+    relay_lines = {name: fake_hardware.relay(name) for name in RELAY_PINS}
     gpio_available = True
-    print("GPIO initialisé (gpiozero)")
-except Exception as e:
-    print(f"GPIO non disponible: {e}")
+else:
+    try:
+        from gpiozero import OutputDevice
+        for name, pin in RELAY_PINS.items():
+            relay_lines[name] = OutputDevice(pin, active_high=True, initial_value=True)
+        gpio_available = True
+        print("GPIO initialisé (gpiozero)")
+    except Exception as e:
+        print(f"GPIO non disponible: {e}")
 
 # Thermocouple type K via MAX6675 (numérotation GPIO/BCM)
 MAX6675_SCK_PIN = 11   # pin physique 23
 MAX6675_CS_PIN = 8     # pin physique 24
 MAX6675_SO_PIN = 9     # pin physique 21
-max6675_available = False
-max6675_lock = threading.Lock()
-max6675_samples = deque(maxlen=5)
-try:
-    from gpiozero import DigitalInputDevice, DigitalOutputDevice
-    max6675_sck = DigitalOutputDevice(MAX6675_SCK_PIN, initial_value=False)
-    max6675_cs = DigitalOutputDevice(MAX6675_CS_PIN, initial_value=True)
-    max6675_so = DigitalInputDevice(MAX6675_SO_PIN, pull_up=None, active_state=True)
-    max6675_available = True
-    print("MAX6675 initialisé (GPIO11/8/9)")
-except Exception as e:
-    print(f"MAX6675 non disponible: {e}")
+MAX6675_SPI_DEVICE = (0, 0)        # /dev/spidev0.0 = mêmes broches en SPI0
+MAX6675_CONVERSION_TIME = 0.22     # le MAX6675 a besoin de 220 ms entre deux lectures
+
+class MAX6675Spidev:
+    """Trame 16 bits lue en une seule transaction SPI matérielle."""
+    name = "spidev"
+
+    def __init__(self, bus, device):
+        import spidev
+        self.spi = spidev.SpiDev()
+        self.spi.open(bus, device)
+        self.spi.max_speed_hz = 1000000
+        self.spi.mode = 0
+
+    def read_raw(self):
+        high, low = self.spi.readbytes(2)
+        return (high << 8) | low
+
+class MAX6675BitBang:
+    """Repli sans SPI noyau : horloge générée à la main par gpiozero."""
+    name = "gpio"
+
+    def __init__(self):
+        from gpiozero import DigitalInputDevice, DigitalOutputDevice
+        self.sck = DigitalOutputDevice(MAX6675_SCK_PIN, initial_value=False)
+        self.cs = DigitalOutputDevice(MAX6675_CS_PIN, initial_value=True)
+        self.so = DigitalInputDevice(MAX6675_SO_PIN, pull_up=None, active_state=True)
+
+    def read_raw(self):
+        value = 0
+        self.sck.off()
+        self.cs.off()
+        time.sleep(0.0001)
+        for _ in range(16):
+            value = (value << 1) | int(self.so.value)
+            self.sck.on()
+            time.sleep(0.00001)
+            self.sck.off()
+            time.sleep(0.00001)
+        self.cs.on()
+        return value
+
+class RunningMedian:
+    """Médiane glissante : liste triée maintenue par insertion/suppression dichotomique."""
+
+    def __init__(self, size):
+        self.window = deque()
+        self.ordered = []
+        self.size = size
+
+    def add(self, value):
+        if len(self.window) == self.size:
+            oldest = self.window.popleft()
+            del self.ordered[bisect_left(self.ordered, oldest)]
+        self.window.append(value)
+        insort(self.ordered, value)
+        middle = len(self.ordered) // 2
+        if len(self.ordered) % 2:
+            return self.ordered[middle]
+        return (self.ordered[middle - 1] + self.ordered[middle]) / 2
+
+    def clear(self):
+        self.window.clear()
+        self.ordered.clear()
+
+class Thermocouple:
+    """MAX6675 filtré, avec respect du temps de conversion de la puce."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.median = RunningMedian(5)
+        self.last_read = float("-inf")
+        self.last_value = None
+        self.last_error = None
+
+    def read(self):
+        """Température filtrée, ou None si le thermocouple est débranché ou la lecture en erreur."""
+        with self.lock:
+            now = time.monotonic()
+            # Relire avant 220 ms interromprait la conversion en cours
+            if now - self.last_read < MAX6675_CONVERSION_TIME:
+                return self.last_value
+            self.last_read = now
+            try:
+                value = self.backend.read_raw()
+            except Exception as e:
+                # Erreur SPI/GPIO : la régulation doit continuer sans la température du four
+                if str(e) != self.last_error:
+                    print(f"MAX6675 error: {e}")
+                self.last_error = str(e)
+                value = None
+            # D2 vaut 1 lorsque le thermocouple est ouvert/débranché.
+            if value is None or value & 0x4:
+                metrics.inc("pr_sensor_read_failures_total", sensor="max6675")
+                self.median.clear()
+                self.last_value = None
+            else:
+                self.last_error = None
+                self.last_value = round(self.median.add(((value >> 3) & 0xFFF) * 0.25), 2)
+            return self.last_value
+
+def init_thermocouple():
+    if fake_hardware is not None:
+        return Thermocouple(fake_hardware.max6675())
+    if os.path.exists("/dev/spidev%d.%d" % MAX6675_SPI_DEVICE):
+        try:
+            backend = MAX6675Spidev(*MAX6675_SPI_DEVICE)
+            print("MAX6675 initialisé (spidev0.0)")
+            return Thermocouple(backend)
+        except Exception as e:
+            print(f"MAX6675 spidev non disponible: {e}")
+    try:
+        backend = MAX6675BitBang()
+        print("MAX6675 initialisé (GPIO11/8/9)")
+        return Thermocouple(backend)
+    except Exception as e:
+        print(f"MAX6675 non disponible: {e}")
+    return None
+
+thermocouple = init_thermocouple()
 
 def set_relay(name, state_on):
     if name in relay_lines:
@@ -69,22 +379,358 @@ def set_relay(name, state_on):
 
 # Historique des capteurs (stockage en mémoire)
 SENSOR_HISTORY_MAX = 3600  # 1h de données à 1s = 3600 points
-sensor_history = {
-    "timestamps": deque(maxlen=SENSOR_HISTORY_MAX),
-    "t1": deque(maxlen=SENSOR_HISTORY_MAX),
-    "t2": deque(maxlen=SENSOR_HISTORY_MAX),
-    "t3": deque(maxlen=SENSOR_HISTORY_MAX),
-    "humidity": deque(maxlen=SENSOR_HISTORY_MAX),
-    "oven": deque(maxlen=SENSOR_HISTORY_MAX)
-}
+NAN = math.nan
+# heater / humidifier : état du relais (0 ou 1) ; leur moyenne sur une tranche est le rapport cyclique
+SERIES_CHANNELS = ["t1", "t2", "t3", "humidity", "oven", "heater", "humidifier"]
+# Paliers agrégés : (nom, durée d'une tranche en s, nombre de tranches conservées)
+SERIES_TIERS = [
+    ("1m", 60, 2 * 24 * 60),      # 2 jours
+    ("15m", 900, 31 * 24 * 4),    # 31 jours
+    ("1h", 3600, 366 * 24),       # 1 an
+]
+
+class Rollup:
+    """Agrégats min/moyenne/max par tranche de `period` secondes, tenus à jour à chaque échantillon."""
+
+    def __init__(self, period, capacity):
+        self.period = period
+        self.buckets = deque(maxlen=capacity)  # (début epoch, {canal: (n, min, moyenne, max)})
+        self.start = None
+        self.acc = {}  # {canal: [n, somme, min, max]} de la tranche en cours
+
+    def add(self, ts, values):
+        """Ajoute un échantillon ; renvoie la tranche précédente si elle vient d'être fermée."""
+        closed = None
+        start = ts - ts % self.period
+        if start != self.start:
+            closed = self.close()
+            self.start = start
+        for channel, value in values.items():
+            if value is None:
+                continue
+            acc = self.acc.get(channel)
+            if acc is None:
+                self.acc[channel] = [1, value, value, value]
+            else:
+                acc[0] += 1
+                acc[1] += value
+                if value < acc[2]:
+                    acc[2] = value
+                if value > acc[3]:
+                    acc[3] = value
+        return closed
+
+    def current(self):
+        if self.start is None:
+            return None
+        return (self.start, {ch: (a[0], a[2], a[1] / a[0], a[3]) for ch, a in self.acc.items()})
+
+    def close(self):
+        bucket = self.current()
+        if bucket is not None:
+            self.buckets.append(bucket)
+        self.start = None
+        self.acc = {}
+        return bucket
+
+    def clear(self):
+        self.buckets.clear()
+        self.start = None
+        self.acc = {}
+
+    def query(self, since=None):
+        """Tranches terminées puis tranche en cours, depuis `since` (epoch) si précisé."""
+        buckets = list(self.buckets)
+        partial = self.current()
+        if partial is not None:
+            buckets.append(partial)
+        if since is not None:
+            buckets = [b for b in buckets if b[0] + self.period > since]
+        return buckets
+
+def format_buckets(buckets, period):
+    """Tranches -> séries JSON : moyennes sous les clés habituelles, enveloppes dans min/max."""
+    def column(channel, idx):
+        return [round(stats[channel][idx], 2) if channel in stats else None for _, stats in buckets]
+    series = {"period": period, "timestamps": [datetime.fromtimestamp(start).isoformat() for start, _ in buckets]}
+    for channel in SERIES_CHANNELS:
+        series[channel] = column(channel, 2)
+    series["min"] = {channel: column(channel, 1) for channel in SERIES_CHANNELS}
+    series["max"] = {channel: column(channel, 3) for channel in SERIES_CHANNELS}
+    series["count"] = {channel: [stats[channel][0] if channel in stats else 0 for _, stats in buckets]
+        for channel in SERIES_CHANNELS}
+    return series
+
+def lttb_indices(xs, ys, threshold):
+    """Largest-Triangle-Three-Buckets : indices des points qui conservent la forme de la courbe."""
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+    every = (n - 2) / (threshold - 2)
+    selected = [0]
+    a = 0
+    for i in range(threshold - 2):
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, n)
+        count = avg_end - avg_start
+        avg_x = sum(xs[avg_start:avg_end]) / count
+        avg_y = sum(ys[avg_start:avg_end]) / count
+        ax, ay = xs[a], ys[a]
+        best_area, best = -1.0, avg_start - 1
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            area = abs((ax - avg_x) * (ys[j] - ay) - (ax - xs[j]) * (avg_y - ay))
+            if area > best_area:
+                best_area, best = area, j
+        selected.append(best)
+        a = best
+    selected.append(n - 1)
+    return selected
+
+def downsample(ts, columns, t_from, t_to, points, agg="mean", reference="t1"):
+    """Courbes sur [t_from, t_to] en au plus `points` points, en une passe par canal.
+
+    `columns` donne pour chaque canal un (n, min, moyenne, max) par horodatage, ou None.
+    mean   : moyenne par tranche de temps, avec enveloppes min/max ;
+    minmax : min puis max de chaque tranche (pics conservés tels quels) ;
+    lttb   : points réels choisis par LTTB sur le canal `reference`."""
+    series = {"agg": agg}
+    if agg == "lttb":
+        ref = columns[reference]
+        valid = [i for i, v in enumerate(ref) if v is not None]
+        keep = [valid[i] for i in lttb_indices([ts[i] for i in valid], [ref[i][2] for i in valid], points)]
+        series["timestamps"] = [datetime.fromtimestamp(ts[i]).isoformat() for i in keep]
+        for channel in SERIES_CHANNELS:
+            column = columns[channel]
+            series[channel] = [round(column[i][2], 2) if column[i] is not None else None for i in keep]
+        return series
+
+    buckets = max(1, points // 2 if agg == "minmax" else points)
+    width = max((t_to - t_from) / buckets, 1e-9)
+    index = [min(max(int((t - t_from) / width), 0), buckets - 1) for t in ts]
+    acc = {}
+    filled = [False] * buckets
+    for channel in SERIES_CHANNELS:
+        n = [0] * buckets
+        total = [0.0] * buckets
+        lo = [math.inf] * buckets
+        hi = [-math.inf] * buckets
+        for b, stats in zip(index, columns[channel]):
+            if stats is None:
+                continue
+            count, vmin, vmean, vmax = stats
+            n[b] += count
+            total[b] += vmean * count
+            if vmin < lo[b]:
+                lo[b] = vmin
+            if vmax > hi[b]:
+                hi[b] = vmax
+            filled[b] = True
+        acc[channel] = (n, total, lo, hi)
+    kept = [b for b in range(buckets) if filled[b]]
+
+    def column(channel, which):
+        n, total, lo, hi = acc[channel]
+        if which == "mean":
+            return [round(total[b] / n[b], 2) if n[b] else None for b in kept]
+        values = lo if which == "min" else hi
+        return [round(values[b], 2) if n[b] else None for b in kept]
+
+    series["period"] = width
+    if agg == "minmax":
+        # Deux points par tranche : au quart (min) et aux trois quarts (max)
+        series["timestamps"] = [datetime.fromtimestamp(t_from + (b + q) * width).isoformat()
+            for b in kept for q in (0.25, 0.75)]
+        for channel in SERIES_CHANNELS:
+            lows, highs = column(channel, "min"), column(channel, "max")
+            series[channel] = [v for pair in zip(lows, highs) for v in pair]
+        return series
+    series["timestamps"] = [datetime.fromtimestamp(t_from + (b + 0.5) * width).isoformat() for b in kept]
+    for channel in SERIES_CHANNELS:
+        series[channel] = column(channel, "mean")
+    series["min"] = {channel: column(channel, "min") for channel in SERIES_CHANNELS}
+    series["max"] = {channel: column(channel, "max") for channel in SERIES_CHANNELS}
+    return series
+
+class RingBuffer:
+    """Tampon circulaire de flottants sur array('d') : 8 octets par valeur, NaN pour une valeur absente."""
+
+    def __init__(self, capacity):
+        self.data = array('d', bytes(8 * capacity))
+        self.capacity = capacity
+        self.start = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.size
+        return self.data[(self.start + i) % self.capacity]
+
+    def append(self, value):
+        self.data[(self.start + self.size) % self.capacity] = NAN if value is None else value
+        if self.size < self.capacity:
+            self.size += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+
+    def clear(self):
+        self.start = 0
+        self.size = 0
+
+    def views(self, first=0, step=1, stop=None):
+        """Vues sans copie des éléments first, first+step, ... jusqu'à stop exclu :
+        un segment, ou deux si le tampon a bouclé."""
+        mv = memoryview(self.data)
+        head = self.start + first
+        end = self.start + (self.size if stop is None else min(stop, self.size))
+        if head >= end:
+            return []
+        if end <= self.capacity:
+            return [mv[head:end:step]]
+        if head >= self.capacity:
+            return [mv[head - self.capacity:end - self.capacity:step]]
+        first_part = mv[head:self.capacity:step]
+        resume = head + len(first_part) * step - self.capacity
+        return [first_part, mv[resume:end - self.capacity:step]]
+
+    def tolist(self, first=0, step=1, stop=None):
+        """Valeurs sélectionnées, NaN converti en None pour le JSON."""
+        return [None if v != v else v for view in self.views(first, step, stop) for v in view.tolist()]
+
+    def values(self, first=0, stop=None):
+        """Valeurs brutes (NaN conservé) de first à stop, pour les calculs."""
+        return [v for view in self.views(first, 1, stop) for v in view.tolist()]
+
+class SensorSeries:
+    """Dernière heure d'échantillons bruts + paliers agrégés couvrant toute la durée d'un batch."""
+
+    def __init__(self):
+        # Horodatage en secondes epoch, un tampon par canal
+        self.raw = {key: RingBuffer(SENSOR_HISTORY_MAX) for key in ["timestamps"] + SERIES_CHANNELS}
+        self.tiers = {name: Rollup(period, capacity) for name, period, capacity in SERIES_TIERS}
+        self.first_ts = None
+
+    def append(self, now, values):
+        """Ajoute un échantillon ; renvoie {palier: tranche} des tranches qui viennent de se fermer."""
+        ts = now.timestamp()
+        if self.first_ts is None:
+            self.first_ts = ts
+        self.raw["timestamps"].append(ts)
+        for channel in SERIES_CHANNELS:
+            self.raw[channel].append(values.get(channel))
+        closed = {}
+        for name, tier in self.tiers.items():
+            bucket = tier.add(ts, values)
+            if bucket is not None:
+                closed[name] = [bucket[0], {ch: list(v) for ch, v in bucket[1].items()}]
+        return closed
+
+    def clear(self):
+        for buf in self.raw.values():
+            buf.clear()
+        for tier in self.tiers.values():
+            tier.clear()
+        self.first_ts = None
+
+    def raw_index(self, since):
+        """Indice du premier échantillon brut postérieur à `since` (epoch)."""
+        return bisect_left(self.raw["timestamps"], since)
+
+    def raw_series(self, first=0, step=1):
+        series = {"timestamps": [datetime.fromtimestamp(ts).isoformat()
+            for ts in self.raw["timestamps"].tolist(first, step)]}
+        for channel in SERIES_CHANNELS:
+            series[channel] = self.raw[channel].tolist(first, step)
+        return series
+
+    def tier_series(self, name, since=None):
+        tier = self.tiers[name]
+        return format_buckets(tier.query(since), tier.period)
+
+    def rows(self, source, t_from, t_to):
+        """Horodatages et {canal: (n, min, moyenne, max) par point} de la source sur [t_from, t_to]."""
+        if source == "raw":
+            timestamps = self.raw["timestamps"]
+            first, stop = bisect_left(timestamps, t_from), bisect_right(timestamps, t_to)
+            ts = timestamps.values(first, stop)
+            columns = {}
+            for channel in SERIES_CHANNELS:
+                values = self.raw[channel].values(first, stop)
+                columns[channel] = [None if v != v else (1, v, v, v) for v in values]
+            return ts, columns
+        buckets = [b for b in self.tiers[source].query(t_from) if b[0] <= t_to]
+        return [b[0] for b in buckets], {channel: [stats.get(channel) for _, stats in buckets]
+            for channel in SERIES_CHANNELS}
+
+    def coverage_tier(self, since):
+        """Palier le plus fin qui couvre encore tout depuis `since` (epoch), ou depuis le
+        premier échantillon si les données sont plus récentes que `since`."""
+        target = max(since, self.first_ts) if self.first_ts is not None else since
+        if len(self.raw["timestamps"]) and self.raw["timestamps"][0] <= target:
+            return "raw"
+        for name, period, _ in SERIES_TIERS:
+            tier = self.tiers[name]
+            first = tier.buckets[0][0] if tier.buckets else tier.start
+            if first is None or first <= target:
+                return name
+        return SERIES_TIERS[-1][0]
+
+    def checkpoint(self):
+        """Tranches en cours de chaque palier : les tranches fermées sont déjà dans le journal du
+        batch, et les échantillons bruts ne sont pas conservés (le palier 1 min prend le relais)."""
+        partial = {}
+        for name, tier in self.tiers.items():
+            bucket = tier.current()
+            if bucket is not None:
+                partial[name] = [bucket[0], {ch: list(v) for ch, v in bucket[1].items()}]
+        return {"first_ts": self.first_ts, "partial": partial}
+
+    def restore(self, data, closed=()):
+        """Reconstruit les paliers à partir des tranches fermées du journal (`closed`, dans
+        l'ordre) et des tranches en cours du point de reprise `data`."""
+        self.clear()
+        data = data or {}
+        if "tiers" in data:
+            # Ancien format : tous les paliers dans le point de reprise, la dernière tranche en cours
+            tiers = data["tiers"]
+            closed = [{name: bucket} for name, buckets in tiers.items() for bucket in buckets[:-1]]
+            data = {"first_ts": data.get("first_ts"),
+                "partial": {name: buckets[-1] for name, buckets in tiers.items() if buckets}}
+        for buckets in closed:
+            for name, (start, stats) in buckets.items():
+                if name in self.tiers:
+                    self.tiers[name].buckets.append((start, {ch: tuple(v) for ch, v in stats.items()}))
+        for name, (start, stats) in data.get("partial", {}).items():
+            tier = self.tiers.get(name)
+            if tier is None or (tier.buckets and tier.buckets[-1][0] >= start):
+                continue  # tranche fermée et journalisée après le point de reprise
+            tier.start = start
+            tier.acc = {ch: [n, mean * n, lo, hi] for ch, (n, lo, mean, hi) in stats.items()}
+        self.first_ts = data.get("first_ts")
+        if self.first_ts is None:
+            starts = [t.buckets[0][0] if t.buckets else t.start for t in self.tiers.values()]
+            starts = [ts for ts in starts if ts is not None]
+            self.first_ts = min(starts) if starts else None
+
+    def export(self):
+        """Toutes les résolutions, pour l'archivage du batch."""
+        series = {"raw": self.raw_series()}
+        for name in self.tiers:
+            series[name] = self.tier_series(name)
+        return series
+
+sensor_series = SensorSeries()
 
 # État global du système
 state = {
     "batch": None,
     "sensors": {
         "temperature": [0.0, 0.0, 0.0],
-        "humidity": 0.0,
-        "temp_sht40": 0.0,
+        "humidity": None,
+        "humidity_ok": False,
+        "temp_sht40": None,
         "oven_temp": None,
         "oven_connected": False
     },
@@ -95,8 +741,14 @@ state = {
         "fan_extract": False
     },
     "mode": "idle",
+    "control": {"heater": 0.0, "humidifier": 0.0},  # rapports cycliques PID (%)
+    "alerts": [],  # clés des alertes en cours
     "events": []
 }
+# Hors batch, rien ne vide les événements (alertes frigo, notes) : on ne garde que les plus récents
+IDLE_EVENTS_MAX = 100
+# Toute mutation de `state` / `sensor_series` se fait sous ce verrou.
+state_lock = threading.RLock()
 
 # Préréglages de fermentation (système)
 SYSTEM_PRESETS = {
@@ -128,146 +780,1007 @@ SYSTEM_PRESETS = {
         "steps": [{"name": "Étape 1", "temp": 30, "humidity": 70, "duration": 24, "ventilation": "off"}]}
 }
 
-HISTORY_FILE = "history.json"
-SETTINGS_FILE = "settings.json"
-CUSTOM_PRESETS_FILE = "custom_presets.json"
+BATCH_JOURNAL_FILE = data_path("batch_journal.jsonl")  # batch en cours, rejoué au redémarrage
+SERIES_CHECKPOINT_FILE = data_path("series_checkpoint.json")
+SERIES_CHECKPOINT_INTERVAL = 300  # s
+HISTORY_FILE = data_path("history.json")  # ancien format, migré dans BATCH_DB_FILE au premier démarrage
+BATCH_DB_FILE = data_path("batches.db")
+SETTINGS_FILE = data_path("settings.json")
+CUSTOM_PRESETS_FILE = data_path("custom_presets.json")
 
 def load_json(filepath, default):
     if os.path.exists(filepath):
         try:
             with open(filepath, 'r') as f:
                 return json.load(f)
-        except:
-            pass
+        except (OSError, ValueError) as e:
+            # Fichier illisible : on le met de côté au lieu de l'écraser au prochain enregistrement
+            corrupt = f"{filepath}.corrupt-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+            print(f"Fichier {filepath} illisible ({e}), déplacé vers {corrupt}")
+            try:
+                os.replace(filepath, corrupt)
+            except OSError:
+                pass
     return default
 
-def save_json(filepath, data):
-    with open(filepath, 'w') as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+def fsync_dir(path):
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+def save_json(filepath, data, indent=2):
+    """Écriture atomique : fichier temporaire synchronisé puis renommé par-dessus l'original."""
+    name = os.path.basename(filepath)
+    with metrics.timer("pr_file_write_seconds", file=name):
+        tmp = f"{filepath}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=indent, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+        os.replace(tmp, filepath)
+        fsync_dir(filepath)
+    metrics.set("pr_file_size_bytes", size, file=name)
+
+PERSIST_TICK = 1.0  # s entre deux passages du thread d'écriture différée
+
+class WriteBehind:
+    """Écriture différée : les modifications fréquentes marquent un fichier « sale », un thread
+    l'écrit au plus une fois par `interval` secondes. flush() force l'écriture (arrêt, fin de batch).
+
+    Chaque fichier a son verrou d'écriture : un flush() depuis une requête attend l'écriture en
+    cours du thread au lieu d'écrire le même fichier temporaire en même temps."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}  # chemin -> {"producer", "interval", "dirty", "written", "lock"}
+        self.thread = None
+
+    def register(self, path, producer, interval):
+        with self.lock:
+            self.entries[path] = {"producer": producer, "interval": interval, "dirty": False, "written": 0.0,
+                "lock": threading.Lock()}
+
+    def mark(self, path):
+        with self.lock:
+            self.entries[path]["dirty"] = True
+
+    def write(self, path, entry):
+        with entry["lock"]:
+            with self.lock:
+                if not entry["dirty"]:
+                    return  # déjà écrit par un autre thread pendant l'attente du verrou
+                entry["dirty"] = False
+                entry["written"] = time.monotonic()
+            try:
+                save_json(path, entry["producer"](), indent=None)
+            except Exception as e:
+                with self.lock:
+                    entry["dirty"] = True
+                print(f"Écriture {path} impossible: {e}")
+
+    def flush(self, path=None):
+        # Sans filtre sur dirty : write() attend une éventuelle écriture en cours puis décide
+        with self.lock:
+            due = [(p, e) for p, e in self.entries.items() if path is None or p == path]
+        for p, entry in due:
+            self.write(p, entry)
+
+    def discard(self, path):
+        """Oublie les modifications en attente et supprime le fichier (après une écriture en cours)."""
+        with self.lock:
+            entry = self.entries[path]
+        with entry["lock"]:
+            with self.lock:
+                entry["dirty"] = False
+            if os.path.exists(path):
+                os.remove(path)
+
+    def run(self):
+        while True:
+            time.sleep(PERSIST_TICK)
+            now = time.monotonic()
+            with self.lock:
+                due = [(p, e) for p, e in self.entries.items() if e["dirty"] and now - e["written"] >= e["interval"]]
+            for path, entry in due:
+                self.write(path, entry)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="write-behind", daemon=True)
+            self.thread.start()
+
+write_behind = WriteBehind()
+
+class BatchJournal:
+    """Journal en ajout seul du batch en cours (démarrage, étapes, événements, tranches de courbes
+    fermées), synchronisé à chaque ligne : quelques octets par changement au lieu de réécrire
+    l'état complet."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def append(self, entry):
+        with self.lock, metrics.timer("pr_file_write_seconds", file=os.path.basename(self.path)):
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def start(self, batch, events):
+        with self.lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        self.append({"type": "start", "batch": batch, "events": events})
+
+    def clear(self):
+        with self.lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def replay(self):
+        """Reconstruit (batch, événements, tranches de courbes) à partir du journal, ou None s'il
+        n'y a pas de batch en cours."""
+        if not os.path.exists(self.path):
+            return None
+        batch, events, buckets = None, [], []
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break  # dernière ligne tronquée par une coupure
+                if entry["type"] == "start":
+                    batch, events, buckets = entry["batch"], entry["events"], []
+                elif batch is None:
+                    continue
+                elif entry["type"] == "step":
+                    batch["current_step_index"] = entry["index"]
+                    batch["current_step"] = batch["steps"][entry["index"]]
+                    batch["step_started_at"] = entry["at"]
+                    batch.setdefault("step_log", []).append({"index": entry["index"], "at": entry["at"]})
+                elif entry["type"] == "event":
+                    events.insert(0, entry["event"])
+                elif entry["type"] == "buckets" and entry["batch"] == batch["id"]:
+                    buckets.append(entry["buckets"])
+        return (batch, events, buckets) if batch else None
+
+class BatchRepository:
+    """Historique des batchs en SQLite : métadonnées indexées, séries capteurs dans une table à part.
+
+    Une connexion par thread (sqlite3 l'impose) ; WAL pour que les lectures ne bloquent pas
+    l'écriture d'un batch qui se termine."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS batches (
+            id TEXT PRIMARY KEY,
+            preset_code TEXT,
+            started_at TEXT,
+            status TEXT,
+            rating INTEGER,
+            data TEXT NOT NULL,
+            summary TEXT,
+            analytics TEXT
+        );
+        CREATE INDEX IF NOT EXISTS batches_preset ON batches(preset_code, id);
+        CREATE INDEX IF NOT EXISTS batches_started ON batches(started_at, id);
+        CREATE TABLE IF NOT EXISTS batch_series (
+            batch_id TEXT NOT NULL REFERENCES batches(id) ON DELETE CASCADE,
+            tier TEXT NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (batch_id, tier)
+        );
+    """
+    SERIES_KEY = "sensor_history"
+    SUMMARY_FIELDS = ["id", "name", "preset", "preset_code", "started_at", "ended_at", "status", "rating",
+        "total_duration"]
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        conn = self.conn()
+        conn.executescript(self.SCHEMA)
+        columns = [r[1] for r in conn.execute("PRAGMA table_info(batches)")]
+        if "summary" not in columns:
+            # Base créée avant les résumés : colonne ajoutée puis remplie une fois
+            with conn:
+                conn.execute("ALTER TABLE batches ADD COLUMN summary TEXT")
+                for batch_id, data in conn.execute("SELECT id, data FROM batches").fetchall():
+                    conn.execute("UPDATE batches SET summary = ? WHERE id = ?",
+                        (json.dumps(self.summarize(json.loads(data)), ensure_ascii=False), batch_id))
+        if "analytics" not in columns:
+            # Analyses calculées à la première demande (voir batch_analytics)
+            with conn:
+                conn.execute("ALTER TABLE batches ADD COLUMN analytics TEXT")
 
-def load_history():
-    return load_json(HISTORY_FILE, [])
+    @classmethod
+    def summarize(cls, record):
+        """Résumé léger pour la liste de l'historique : ni séries capteurs ni événements."""
+        summary = {k: record.get(k) for k in cls.SUMMARY_FIELDS}
+        summary["step_count"] = len(record.get("steps") or [])
+        summary["event_count"] = len(record.get("events") or [])
+        return summary
 
-def save_history(history):
-    save_json(HISTORY_FILE, history)
+    def conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self.local.conn = conn
+        return conn
+
+    def insert(self, record, series=None, conn=None, replace=True):
+        """Enregistre un batch ; `series` = {palier: séries} (un sensor_history intégré devient 'raw').
+        Avec replace=False, un identifiant déjà présent lève sqlite3.IntegrityError."""
+        record = dict(record)
+        series = dict(series or {})
+        if self.SERIES_KEY in record:
+            series.setdefault("raw", record.pop(self.SERIES_KEY))
+        conn = conn or self.conn()
+        with metrics.timer("pr_db_write_seconds", op="insert"), conn:
+            conn.execute(("INSERT OR REPLACE" if replace else "INSERT") +
+                " INTO batches (id, preset_code, started_at, status, rating, data, summary) VALUES (?, ?, ?, ?, ?, ?, ?)", (record["id"], record.get("preset_code"), record.get("started_at"),
+                record.get("status"), record.get("rating", 0), json.dumps(record, ensure_ascii=False),
+                json.dumps(self.summarize(record), ensure_ascii=False)))
+            for tier, data in series.items():
+                conn.execute("INSERT OR REPLACE INTO batch_series (batch_id, tier, data) VALUES (?, ?, ?)",
+                    (record["id"], tier, json.dumps(data)))
+
+    def get(self, batch_id, with_series=True, tier=None):
+        """Batch complet ; sensor_history contient le palier demandé, par défaut le plus fin
+        couvrant toute la durée du batch."""
+        row = self.conn().execute("SELECT data FROM batches WHERE id = ?", (batch_id,)).fetchone()
+        if row is None:
+            return None
+        record = json.loads(row[0])
+        if with_series:
+            tier = tier or record.get("series_tier", "raw")
+            series = self.conn().execute("SELECT data FROM batch_series WHERE batch_id = ? AND tier = ?",
+                (batch_id, tier)).fetchone()
+            if series is not None:
+                record[self.SERIES_KEY] = json.loads(series[0])
+            record["series_tiers"] = [r[0] for r in self.conn().execute(
+                "SELECT tier FROM batch_series WHERE batch_id = ?", (batch_id,))]
+        return record
+
+    def cached_analytics(self, batch_id):
+        """Analyse enregistrée avec le batch ; None si elle n'a pas encore été calculée. Un
+        nouvel enregistrement du batch (INSERT OR REPLACE) l'efface."""
+        row = self.conn().execute("SELECT analytics FROM batches WHERE id = ?", (batch_id,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def store_analytics(self, batch_id, analytics):
+        conn = self.conn()
+        with metrics.timer("pr_db_write_seconds", op="analytics"), conn:
+            conn.execute("UPDATE batches SET analytics = ? WHERE id = ?", (json.dumps(analytics), batch_id))
+
+    def preset_analytics(self, preset_code):
+        """[(résumé, analyse ou None)] des batchs d'un préréglage, du plus ancien au plus récent."""
+        rows = self.conn().execute("SELECT summary, analytics FROM batches WHERE preset_code = ? "
+            "ORDER BY started_at, id", (preset_code,)).fetchall()
+        return [(json.loads(summary), json.loads(analytics) if analytics else None) for summary, analytics in rows]
+
+    def summaries(self, limit, after=None, preset_code=None, status=None):
+        """Page de résumés, du plus récent au plus ancien (pagination par clé sur started_at, id).
+
+        `after` est le couple (started_at, id) du dernier élément de la page précédente.
+        Retourne (résumés, clé de la page suivante ou None)."""
+        where, params = [], []
+        if after:
+            where.append("(started_at < ? OR (started_at = ? AND id < ?))")
+            params += [after[0], after[0], after[1]]
+        if preset_code:
+            where.append("preset_code = ?")
+            params.append(preset_code)
+        if status:
+            where.append("status = ?")
+            params.append(status)
+        sql = "SELECT summary FROM batches"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY started_at DESC, id DESC LIMIT ?"
+        rows = self.conn().execute(sql, params + [limit + 1]).fetchall()
+        items = [json.loads(r[0]) for r in rows[:limit]]
+        next_key = None
+        if len(rows) > limit:
+            next_key = (items[-1]["started_at"], items[-1]["id"])
+        return items, next_key
+
+    def iter_summaries(self, t_from=None, t_to=None, preset_code=None, status=None, page=200):
+        """Résumés des batchs démarrés dans [t_from, t_to[ (ISO), du plus ancien au plus récent,
+        lus par pages : ni tout l'historique en mémoire, ni transaction ouverte entre deux pages."""
+        after = ("", "")
+        while True:
+            where, params = ["(started_at > ? OR (started_at = ? AND id > ?))"], [after[0], after[0], after[1]]
+            if t_from:
+                where.append("started_at >= ?")
+                params.append(t_from)
+            if t_to:
+                where.append("started_at < ?")
+                params.append(t_to)
+            if preset_code:
+                where.append("preset_code = ?")
+                params.append(preset_code)
+            if status:
+                where.append("status = ?")
+                params.append(status)
+            rows = self.conn().execute("SELECT summary FROM batches WHERE " + " AND ".join(where) +
+                " ORDER BY started_at, id LIMIT ?", params + [page]).fetchall()
+            for row in rows:
+                yield json.loads(row[0])
+            if len(rows) < page:
+                return
+            last = json.loads(rows[-1][0])
+            after = (last["started_at"], last["id"])
+
+    def series(self, batch_id, tier):
+        row = self.conn().execute("SELECT data FROM batch_series WHERE batch_id = ? AND tier = ?",
+            (batch_id, tier)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update(self, batch_id, fields):
+        conn = self.conn()
+        with conn:
+            row = conn.execute("SELECT data FROM batches WHERE id = ?", (batch_id,)).fetchone()
+            if row is None:
+                return False
+            record = {**json.loads(row[0]), **fields}
+            conn.execute("UPDATE batches SET status = ?, rating = ?, data = ?, summary = ? WHERE id = ?",
+                (record.get("status"), record.get("rating", 0), json.dumps(record, ensure_ascii=False),
+                json.dumps(self.summarize(record), ensure_ascii=False), batch_id))
+        return True
+
+    def delete(self, batch_id):
+        conn = self.conn()
+        with conn:
+            return conn.execute("DELETE FROM batches WHERE id = ?", (batch_id,)).rowcount > 0
+
+    def next_batch_id(self, preset_code):
+        # Numéro suivant le plus grand existant : un batch supprimé ne provoque pas de doublon
+        # (le suffixe d'un doublon renuméroté à la migration, « #T-0002b », est ignoré)
+        row = self.conn().execute("SELECT id FROM batches WHERE preset_code = ? ORDER BY id DESC LIMIT 1",
+            (preset_code,)).fetchone()
+        try:
+            count = int(row[0].rsplit("-", 1)[1].rstrip("abcdefghijklmnopqrstuvwxyz")) + 1 if row else 1
+        except (IndexError, ValueError):
+            count = self.conn().execute("SELECT COUNT(*) FROM batches WHERE preset_code = ?",
+                (preset_code,)).fetchone()[0] + 1
+        return f"#{preset_code}-{count:04d}"
+
+    def migrate_json(self, filepath):
+        """Importe un ancien history.json en une transaction, puis le renomme en .migrated.
+
+        L'ancien generate_batch_id réutilisait un numéro après une suppression : un identifiant
+        déjà vu reçoit un suffixe (#T-0002b) au lieu d'écraser le batch précédent."""
+        if not os.path.exists(filepath):
+            return 0
+        with open(filepath, 'r') as f:
+            history = json.load(f)
+        conn = self.conn()
+        inserted = 0
+        with conn:
+            for record in history:
+                if not record.get("id"):
+                    continue
+                batch_id = record["id"]
+                for suffix in "bcdefghijklmnopqrstuvwxyz":
+                    if conn.execute("SELECT 1 FROM batches WHERE id = ?", (batch_id,)).fetchone() is None:
+                        break
+                    batch_id = f"{record['id']}{suffix}"
+                else:
+                    print(f"Historique: batch {record['id']} ignoré, trop de doublons")
+                    continue
+                if batch_id != record["id"]:
+                    print(f"Historique: doublon {record['id']} ({record.get('started_at')}) renuméroté {batch_id}")
+                    record = {**record, "id": batch_id}
+                self.insert(record, conn=conn, replace=False)
+                inserted += 1
+        os.replace(filepath, filepath + ".migrated")
+        print(f"Historique: {inserted}/{len(history)} batchs migrés depuis {filepath}")
+        return inserted
+
+batch_repo = BatchRepository(BATCH_DB_FILE)
+try:
+    batch_repo.migrate_json(HISTORY_FILE)
+except Exception as e:
+    print(f"Migration historique impossible: {e}")
+
+SETTINGS_DEFAULTS = {"temp_alert_delay": 20, "humidity_tolerance": 10}
 
 def load_settings():
-    return load_json(SETTINGS_FILE, {"temp_alert_delay": 20, "humidity_tolerance": 10})
+    settings = load_json(SETTINGS_FILE, SETTINGS_DEFAULTS)
+    if not isinstance(settings, dict):
+        print(f"{SETTINGS_FILE}: format invalide, réglages par défaut")
+        return dict(SETTINGS_DEFAULTS)
+    return settings
 
 def save_settings(settings):
     save_json(SETTINGS_FILE, settings)
 
-def load_custom_presets():
-    return load_json(CUSTOM_PRESETS_FILE, {})
+def validate_settings(settings):
+    """Vérifie les réglages envoyés à /api/settings ; lève ValueError avec un message lisible."""
+    if not isinstance(settings, dict):
+        raise ValueError("Réglages: format invalide")
+    for key in SETTINGS_DEFAULTS:
+        v = settings.get(key)
+        if key in settings and (isinstance(v, bool) or not isinstance(v, (int, float))
+                or not math.isfinite(v) or not v > 0):
+            raise ValueError(f"{key} doit être un nombre positif")
+    dwell = settings.get("relay_min_dwell", {})
+    if not isinstance(dwell, dict):
+        raise ValueError("relay_min_dwell: format invalide")
+    for name, values in dwell.items():
+        if name not in RELAY_PINS:
+            raise ValueError(f"relay_min_dwell: canal {name} inconnu ({', '.join(RELAY_PINS)})")
+        if not isinstance(values, dict):
+            raise ValueError(f"relay_min_dwell.{name}: format invalide")
+        for field, v in values.items():
+            if field not in ("on", "off"):
+                raise ValueError(f"relay_min_dwell.{name}: paramètre {field} inconnu (on, off)")
+            if isinstance(v, bool) or not isinstance(v, (int, float)) or not math.isfinite(v) or v < 0:
+                raise ValueError(f"relay_min_dwell.{name}.{field} doit être un nombre de secondes positif ou nul")
+    return settings
+
+def setting_number(settings, key):
+    """Réglage numérique positif, ou sa valeur par défaut si settings.json en contient une invalide."""
+    v = settings.get(key, SETTINGS_DEFAULTS[key])
+    if isinstance(v, bool) or not isinstance(v, (int, float)) or not math.isfinite(v) or not v > 0:
+        print(f"Réglage {key}={v!r} ignoré, valeur par défaut {SETTINGS_DEFAULTS[key]}")
+        return float(SETTINGS_DEFAULTS[key])
+    return float(v)
+
+VENTILATION_MODES = ("off", "on", "cyclic")
+STEP_LIMITS = {"temp": (0, 90), "humidity": (0, 100)}  # plages acceptées pour une consigne
+
+def validate_steps(steps):
+    """Vérifie un profil avant qu'il n'atteigne la régulation ; lève ValueError avec un message lisible."""
+    if not isinstance(steps, list) or not steps:
+        raise ValueError("Aucune étape")
+    clean = []
+    for i, step in enumerate(steps, 1):
+        if not isinstance(step, dict):
+            raise ValueError(f"Étape {i}: format invalide")
+        values = {}
+        for field, (lo, hi) in STEP_LIMITS.items():
+            v = step.get(field)
+            if isinstance(v, bool) or not isinstance(v, (int, float)) or not lo <= v <= hi:
+                raise ValueError(f"Étape {i}: {field} doit être un nombre entre {lo} et {hi}")
+            values[field] = v
+        duration = step.get("duration")
+        if isinstance(duration, bool) or not isinstance(duration, (int, float)) or not duration > 0:
+            raise ValueError(f"Étape {i}: duration doit être un nombre d'heures positif")
+        ventilation = step.get("ventilation", "off")
+        if ventilation not in VENTILATION_MODES:
+            raise ValueError(f"Étape {i}: ventilation doit valoir {', '.join(VENTILATION_MODES)}")
+        clean.append({**step, "name": str(step.get("name") or f"Étape {i}"), **values,
+            "duration": duration, "ventilation": ventilation})
+    return clean
+
+def validate_pid(gains):
+    """Vérifie des gains PID {"heater": {"kp": …, "ki": …, "kd": …, "window": …}, "humidifier": …} ;
+    toutes les clés sont facultatives. Lève ValueError avec un message lisible."""
+    if gains is None:
+        return None
+    if not isinstance(gains, dict):
+        raise ValueError("pid: format invalide")
+    clean = {}
+    for name, values in gains.items():
+        if name not in PID_DEFAULTS:
+            raise ValueError(f"pid: canal {name} inconnu (heater ou humidifier)")
+        if not isinstance(values, dict):
+            raise ValueError(f"pid.{name}: format invalide")
+        for field, v in values.items():
+            if field not in PID_DEFAULTS[name]:
+                raise ValueError(f"pid.{name}: paramètre {field} inconnu (kp, ki, kd, window)")
+            if isinstance(v, bool) or not isinstance(v, (int, float)) or not math.isfinite(v):
+                raise ValueError(f"pid.{name}.{field} doit être un nombre")
+            if field == "window" and not v > 0:
+                raise ValueError(f"pid.{name}.window doit être un nombre de secondes positif")
+        clean[name] = dict(values)
+    return clean
+
+class PresetRegistry:
+    """Préréglages système + personnalisés, gardés en mémoire.
+
+    Le fichier n'est relu que si sa date de modification change (édition à la main, autre
+    processus) ; les profils sont validés à l'écriture, et la réponse JSON de /api/presets
+    est sérialisée une seule fois avec son ETag."""
+
+    def __init__(self, path, system):
+        self.path = path
+        self.system = system
+        self.lock = threading.Lock()
+        self.stamp = None
+        self.stored = {}  # contenu du fichier, y compris les entrées invalides (jamais perdues)
+        self.custom = {}
+        self.presets = {}
+        self.body = b""
+        self.etag = ""
+
+    def file_stamp(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            return None
+
+    def refresh(self):
+        stamp = self.file_stamp()
+        if stamp == self.stamp and self.body:
+            return
+        self.publish(load_json(self.path, {}), stamp)
+
+    def publish(self, stored, stamp):
+        custom = {}
+        for key, preset in stored.items():
+            try:
+                validate_pid(preset.get("pid"))
+                custom[key] = {**preset, "steps": validate_steps(preset.get("steps"))}
+            except (ValueError, AttributeError) as e:
+                print(f"Préréglage {key} ignoré: {e}")
+        presets = {**self.system}
+        for key, preset in custom.items():
+            presets[key] = {**preset, "system": False}
+        self.stored = stored
+        self.custom = custom
+        self.presets = presets
+        self.body = json.dumps(presets, ensure_ascii=False).encode()
+        self.etag = hashlib.md5(self.body).hexdigest()
+        self.stamp = stamp
+
+    def all(self):
+        with self.lock:
+            self.refresh()
+            return self.presets
+
+    def get(self, key):
+        return self.all().get(key)
+
+    def payload(self):
+        with self.lock:
+            self.refresh()
+            return self.body, self.etag
+
+    def save(self, key, preset):
+        validate_pid(preset.get("pid"))
+        preset = {**preset, "steps": validate_steps(preset.get("steps"))}
+        with self.lock:
+            self.refresh()
+            stored = {**self.stored, key: preset}
+            save_json(self.path, stored)
+            self.publish(stored, self.file_stamp())
 
-def save_custom_presets(presets):
-    save_json(CUSTOM_PRESETS_FILE, presets)
+    def delete(self, key):
+        with self.lock:
+            self.refresh()
+            if key not in self.stored:
+                return False
+            stored = {k: v for k, v in self.stored.items() if k != key}
+            save_json(self.path, stored)
+            self.publish(stored, self.file_stamp())
+            return True
 
-def get_all_presets():
-    custom = load_custom_presets()
-    all_presets = {**SYSTEM_PRESETS}
-    for key, preset in custom.items():
-        all_presets[key] = {**preset, "system": False}
-    return all_presets
+preset_registry = PresetRegistry(CUSTOM_PRESETS_FILE, SYSTEM_PRESETS)
+
+# Sondes DS18B20 (1-Wire). PR_W1_PATH permet de pointer vers une arborescence factice (voir hwsim.py)
+W1_DEVICES_PATH = fake_hardware.w1_root if fake_hardware else os.environ.get("PR_W1_PATH", "/sys/bus/w1/devices/")
+W1_CONVERSION_TIMEOUT = 1.5  # 750 ms en 12 bits, avec marge
+ds18b20_paths = None
+w1_masters = None  # fichiers therm_bulk_read des maîtres 1-Wire, résolus avec ds18b20_paths
+ds18b20_pool = None
+ds18b20_missing = set()  # sondes sans mesure au dernier cycle (leur valeur reste à 0.0)
+
+def ds18b20_device_paths():
+    """Chemins w1_slave des sondes de SENSOR_MAP et therm_bulk_read des maîtres, résolus en un
+    seul parcours du dossier ; remettre ds18b20_paths à None provoque un nouveau parcours."""
+    global ds18b20_paths, w1_masters
+    if ds18b20_paths is None:
+        devices = set(os.listdir(W1_DEVICES_PATH))
+        masters = [os.path.join(W1_DEVICES_PATH, d, "therm_bulk_read") for d in sorted(devices)
+            if d.startswith("w1_bus_master")]
+        w1_masters = [m for m in masters if os.path.exists(m)]
+        ds18b20_paths = {label: os.path.join(W1_DEVICES_PATH, device, "w1_slave")
+            for device, label in SENSOR_MAP.items() if device in devices}
+    return ds18b20_paths
+
+def w1_bulk_convert():
+    """Lance la conversion simultanée de toutes les sondes via therm_bulk_read.
+
+    Retourne False si aucun maître 1-Wire n'expose cette interface (noyau ancien).
+    Les maîtres sont ceux trouvés par ds18b20_device_paths(), appelée avant."""
+    masters = w1_masters
+    if not masters:
+        return False
+    for m in masters:
+        with open(m, "w") as f:
+            f.write("trigger\n")
+    deadline = time.monotonic() + W1_CONVERSION_TIMEOUT
+    for m in masters:
+        # -1 : conversion en cours sur au moins une sonde
+        while time.monotonic() < deadline:
+            with open(m, "r") as f:
+                if f.read().strip() != "-1":
+                    break
+            time.sleep(0.05)
+    return True
+
+def read_w1_slave(path):
+    try:
+        with open(path, "r") as f:
+            lines = f.readlines()
+    except OSError:
+        return None  # sonde débranchée depuis le dernier scan
+    if lines[0].strip().endswith("YES"):
+        pos = lines[1].find("t=")
+        if pos != -1:
+            return round(float(lines[1][pos+2:]) / 1000.0, 1)
+    return None
 
 def read_ds18b20():
+    global ds18b20_paths, w1_masters, ds18b20_pool, ds18b20_missing
     result = {"t1": 0.0, "t2": 0.0, "t3": 0.0}
-    w1_path = "/sys/bus/w1/devices/"
+    missing = set(result)
+    if fake_hardware is not None:
+        fake_hardware.refresh_w1()
     try:
-        for device in os.listdir(w1_path):
-            if device.startswith("28-") and device in SENSOR_MAP:
-                with open(f"{w1_path}{device}/w1_slave", "r") as f:
-                    lines = f.readlines()
-                    if lines[0].strip().endswith("YES"):
-                        pos = lines[1].find("t=")
-                        if pos != -1:
-                            temp = float(lines[1][pos+2:]) / 1000.0
-                            result[SENSOR_MAP[device]] = round(temp, 1)
+        paths = ds18b20_device_paths()
+        if w1_bulk_convert():
+            # Les valeurs sont déjà converties : chaque lecture est immédiate
+            values = {label: read_w1_slave(path) for label, path in paths.items()}
+        else:
+            # Repli : une conversion par sonde, mais toutes en parallèle
+            if ds18b20_pool is None:
+                ds18b20_pool = ThreadPoolExecutor(max_workers=len(SENSOR_MAP), thread_name_prefix="w1")
+            futures = {label: ds18b20_pool.submit(read_w1_slave, path) for label, path in paths.items()}
+            values = {label: fut.result() for label, fut in futures.items()}
+        for label in result:
+            temp = values.get(label)
+            if temp is not None:
+                result[label] = temp
+                missing.discard(label)
+            else:
+                metrics.inc("pr_sensor_read_failures_total", sensor=label)
+        if len(paths) < len(SENSOR_MAP) or None in values.values():
+            # Sonde absente ou illisible : sondes et maîtres sont rescannés au prochain cycle
+            ds18b20_paths = w1_masters = None
     except Exception as e:
+        ds18b20_paths = w1_masters = None
+        metrics.inc("pr_sensor_read_failures_total", sensor="ds18b20")
         print(f"Erreur DS18B20: {e}")
+    ds18b20_missing = missing
     return [result["t1"], result["t2"], result["t3"]]
 
-def read_sht40():
-    try:
+# Modes du SHT40 (adafruit_sht4x.Mode) : précision de mesure et chauffage intégré
+SHT40_MODES = ["NOHEAT_HIGHPRECISION", "NOHEAT_MEDPRECISION", "NOHEAT_LOWPRECISION",
+    "HIGHHEAT_1S", "HIGHHEAT_100MS", "MEDHEAT_1S", "MEDHEAT_100MS", "LOWHEAT_1S", "LOWHEAT_100MS"]
+
+class SHT40Driver:
+    """Pilote SHT40 persistant : initialisé une fois, reconnecté avec backoff après une erreur I2C."""
+    BACKOFF_MIN = 1.0
+    BACKOFF_MAX = 60.0
+
+    def __init__(self, mode="NOHEAT_HIGHPRECISION"):
+        self.mode = mode
+        self.sensor = None
+        self.available = True  # False si la bibliothèque est absente : inutile de réessayer
+        self.backoff = self.BACKOFF_MIN
+        self.retry_at = 0.0
+        self.last_error = None
+        self.lock = threading.Lock()  # le bus I2C n'est utilisé que par un appelant à la fois
+
+    def connect(self):
+        if fake_hardware is not None:
+            self.sensor = fake_hardware.sht4x()
+            self.sensor.mode = self.mode
+            return
         import board
         import adafruit_sht4x
-        sht = adafruit_sht4x.SHT4x(board.I2C())
-        return sht.relative_humidity, sht.temperature
-    except Exception as e:
-        print(f"SHT40 error: {e}")
-        return None, None
+        self.sensor = adafruit_sht4x.SHT4x(board.I2C())
+        self.sensor.mode = getattr(adafruit_sht4x.Mode, self.mode)
+        print(f"SHT40 initialisé (n° {self.sensor.serial_number:08x}, mode {self.mode})")
 
-def read_max6675():
-    """Lit une trame 16 bits du MAX6675. Retourne None si la sonde est absente."""
-    if not max6675_available:
-        return None
-    with max6675_lock:
-        value = 0
-        max6675_sck.off()
-        max6675_cs.off()
-        time.sleep(0.0001)
-        for _ in range(16):
-            value = (value << 1) | int(max6675_so.value)
-            max6675_sck.on()
-            time.sleep(0.00001)
-            max6675_sck.off()
-            time.sleep(0.00001)
-        max6675_cs.on()
+    def set_mode(self, mode):
+        if mode not in SHT40_MODES:
+            raise ValueError(f"Mode SHT40 inconnu: {mode}")
+        with self.lock:
+            self.mode = mode
+            if fake_hardware is not None and self.sensor is not None:
+                self.sensor.mode = mode
+            elif self.sensor is not None:
+                import adafruit_sht4x
+                self.sensor.mode = getattr(adafruit_sht4x.Mode, mode)
+
+    def fail(self, error):
+        self.sensor = None
+        metrics.inc("pr_sensor_read_failures_total", sensor="sht40")
+        if str(error) != self.last_error:
+            print(f"SHT40 error: {error}")
+        self.last_error = str(error)
+        self.retry_at = time.monotonic() + self.backoff
+        self.backoff = min(self.backoff * 2, self.BACKOFF_MAX)
+
+    def read(self):
+        """Retourne (humidité, température) ou (None, None) si la mesure est indisponible."""
+        with self.lock:
+            return self._read()
+
+    def _read(self):
+        if not self.available:
+            return None, None
+        if self.sensor is None:
+            if time.monotonic() < self.retry_at:
+                return None, None
+            try:
+                self.connect()
+            except ImportError as e:
+                self.available = False
+                print(f"SHT40 non disponible: {e}")
+                return None, None
+            except Exception as e:
+                self.fail(e)
+                return None, None
+        try:
+            temperature, humidity = self.sensor.measurements
+        except Exception as e:
+            self.fail(e)
+            return None, None
+        self.backoff = self.BACKOFF_MIN
+        self.last_error = None
+        return round(humidity, 1), round(temperature, 2)
 
-    # D2 vaut 1 lorsque le thermocouple est ouvert/débranché.
-    if value & 0x4:
-        max6675_samples.clear()
+    def status(self):
+        return {"available": self.available, "connected": self.sensor is not None,
+            "mode": self.mode, "modes": SHT40_MODES, "last_error": self.last_error}
+
+sht40 = SHT40Driver(os.environ.get("PR_SHT40_MODE", "NOHEAT_HIGHPRECISION"))
+
+def read_sht40():
+    return sht40.read()
+
+def read_max6675():
+    """Température du four filtrée. Retourne None si la sonde est absente."""
+    if thermocouple is None:
         return None
-    temperature = ((value >> 3) & 0xFFF) * 0.25
-    max6675_samples.append(temperature)
-    ordered = sorted(max6675_samples)
-    middle = len(ordered) // 2
-    if len(ordered) % 2:
-        filtered = ordered[middle]
-    else:
-        filtered = (ordered[middle - 1] + ordered[middle]) / 2
-    return round(filtered, 2)
+    return thermocouple.read()
 
 def read_sensors():
-    temps = read_ds18b20()
-    oven_temp = read_max6675()
-    state["sensors"]["temperature"] = temps
-    state["sensors"]["fridge_temp"] = temps[2]  # T3 = frigo
-    state["sensors"]["oven_temp"] = oven_temp
-    state["sensors"]["oven_connected"] = oven_temp is not None
-    hum, temp_sht = read_sht40()
-    if hum is not None:
+    # Lectures matérielles hors verrou : elles peuvent prendre plusieurs centaines de ms
+    with metrics.timer("pr_sensor_read_seconds", sensor="ds18b20"):
+        temps = read_ds18b20()
+    with metrics.timer("pr_sensor_read_seconds", sensor="max6675"):
+        oven_temp = read_max6675()
+    with metrics.timer("pr_sensor_read_seconds", sensor="sht40"):
+        hum, temp_sht = read_sht40()
+    with state_lock:
+        state["sensors"]["temperature"] = temps
+        state["sensors"]["fridge_temp"] = temps[2]  # T3 = frigo
+        state["sensors"]["oven_temp"] = oven_temp
+        state["sensors"]["oven_connected"] = oven_temp is not None
+        # Pas de valeur par défaut : une humidité inconnue reste None
         state["sensors"]["humidity"] = hum
         state["sensors"]["temp_sht40"] = temp_sht
-    else:
-        state["sensors"]["humidity"] = 50.0
-        state["sensors"]["temp_sht40"] = sum(temps[:2]) / 2 if any(temps[:2]) else 22.0
-    
+        state["sensors"]["humidity_ok"] = hum is not None
+
+        # Enregistrer dans l'historique
+        closed = sensor_series.append(datetime.now(), {"t1": temps[0], "t2": temps[1], "t3": temps[2],
+            "humidity": hum, "oven": oven_temp, "heater": float(state["actuators"]["heater"]),
+            "humidifier": float(state["actuators"]["humidifier"])})
+        batch_id = state["batch"]["id"] if state["batch"] else None
+
+    # Tranches fermées journalisées hors verrou (une ligne par minute au plus)
+    if closed and batch_id:
+        batch_journal.append({"type": "buckets", "batch": batch_id, "buckets": closed})
+
     # Log HACCP frigo
     if temps[2] > 0:
-        log_haccp(temps[2])
-    
-    # Enregistrer dans l'historique
-    now = datetime.now().isoformat()
-    sensor_history["timestamps"].append(now)
-    sensor_history["t1"].append(temps[0])
-    sensor_history["t2"].append(temps[1])
-    sensor_history["t3"].append(temps[2])
-    sensor_history["humidity"].append(state["sensors"]["humidity"])
-    sensor_history["oven"].append(oven_temp)
+        with metrics.timer("pr_haccp_log_seconds"):
+            log_haccp(temps[2])
+
+# Temps minimum (s) qu'un relais passe dans un état avant de pouvoir rebasculer.
+# Surchargeable dans settings.json : {"relay_min_dwell": {"humidifier": {"on": 30, "off": 60}}}
+RELAY_MIN_DWELL = {
+    "fan_internal": {"on": 30, "off": 30},
+    "fan_extract": {"on": 30, "off": 30},
+    "humidifier": {"on": 20, "off": 40},
+    "heater": {"on": 0, "off": 0},  # SSR : pas d'usure mécanique
+}
+RELAY_STATS_FILE = data_path("relay_stats.json")
+RELAY_STATS_SAVE_INTERVAL = 600  # s, via l'écriture différée
+
+class RelayManager:
+    """Seul point d'accès aux relais : le GPIO n'est touché que sur un vrai changement d'état,
+    les temps minimum ON/OFF sont respectés et chaque canal compte ses commutations et
+    son temps d'allumage (pour planifier le remplacement des relais)."""
+
+    def __init__(self, names, dwell, stats_file):
+        self.dwell = dwell
+        self.stats_file = stats_file
+        self.lock = threading.Lock()
+        self.state = {name: False for name in names}  # initial_value=True -> relais ouverts
+        self.changed_at = {name: float("-inf") for name in names}
+        saved = load_json(stats_file, {})
+        now = datetime.now().isoformat()
+        self.stats = {name: {"switches": 0, "on_seconds": 0.0, "since": now, **saved.get(name, {})}
+            for name in names}
+        self.on_since = {}
+
+    def remaining(self, name, now):
+        """Secondes avant que le canal ait le droit de changer d'état."""
+        held = now - self.changed_at[name]
+        return max(0.0, self.dwell[name]["on" if self.state[name] else "off"] - held)
+
+    def set(self, name, on, now=None, force=False):
+        """Demande un état ; retourne l'état effectif du relais (inchangé si le temps minimum court
+        encore, sauf avec force=True pour une coupure de sécurité)."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            on = bool(on)
+            if self.state[name] == on or (not force and self.remaining(name, now) > 0):
+                return self.state[name]
+            set_relay(name, on)
+            self.state[name] = on
+            self.changed_at[name] = now
+            self.stats[name]["switches"] += 1
+            if on:
+                self.on_since[name] = now
+            elif name in self.on_since:
+                self.stats[name]["on_seconds"] += now - self.on_since.pop(name)
+            return on
+
+    def report(self):
+        now = time.monotonic()
+        with self.lock:
+            report = {}
+            for name, stats in self.stats.items():
+                on_seconds = stats["on_seconds"] + (now - self.on_since[name] if name in self.on_since else 0)
+                elapsed = (datetime.now() - datetime.fromisoformat(stats["since"])).total_seconds()
+                report[name] = {"state": self.state[name], "switches": stats["switches"],
+                    "on_hours": round(on_seconds / 3600, 2),
+                    "duty_pct": round(100 * on_seconds / elapsed, 1) if elapsed > 0 else 0.0,
+                    "since": stats["since"], "min_on": self.dwell[name]["on"], "min_off": self.dwell[name]["off"],
+                    "retry_in": round(self.remaining(name, now), 1)}
+            return report
+
+    def reset(self, name):
+        """Remise à zéro des compteurs d'un canal (relais remplacé)."""
+        with self.lock:
+            self.stats[name] = {"switches": 0, "on_seconds": 0.0, "since": datetime.now().isoformat()}
+            if name in self.on_since:
+                self.on_since[name] = time.monotonic()
+
+    def stats_snapshot(self):
+        """Compteurs à enregistrer ; le temps d'allumage en cours est compté jusqu'à maintenant."""
+        now = time.monotonic()
+        with self.lock:
+            for name in self.on_since:
+                self.stats[name]["on_seconds"] += now - self.on_since[name]
+                self.on_since[name] = now
+            return {name: dict(s) for name, s in self.stats.items()}
+
+def load_relay_dwell(settings):
+    """Temps minimum par canal : défauts surchargés par settings.json, entrées invalides ignorées."""
+    dwell = {name: dict(RELAY_MIN_DWELL[name]) for name in RELAY_PINS}
+    overrides = settings.get("relay_min_dwell", {})
+    if not isinstance(overrides, dict):
+        print(f"Réglage relay_min_dwell={overrides!r} ignoré")
+        return dwell
+    for name, values in overrides.items():
+        if name not in dwell or not isinstance(values, dict):
+            print(f"Réglage relay_min_dwell.{name}={values!r} ignoré")
+            continue
+        for field, v in values.items():
+            if (field not in ("on", "off") or isinstance(v, bool) or not isinstance(v, (int, float))
+                    or not math.isfinite(v) or v < 0):
+                print(f"Réglage relay_min_dwell.{name}.{field}={v!r} ignoré")
+                continue
+            dwell[name][field] = v
+    return dwell
+
+relay_dwell = load_relay_dwell(load_settings())
+relays = RelayManager(list(RELAY_PINS), relay_dwell, RELAY_STATS_FILE)
+write_behind.register(RELAY_STATS_FILE, relays.stats_snapshot, RELAY_STATS_SAVE_INTERVAL)
+
+# Régulation PID par défaut ; un préréglage peut les surcharger avec une clé "pid".
+# kp en % de puissance par °C (ou par point d'HR), ki par unité·s, kd par unité/s,
+# window = période de la sortie tout-ou-rien proportionnelle au temps (s).
+PID_DEFAULTS = {
+    "heater": {"kp": 25.0, "ki": 0.02, "kd": 600.0, "window": 30},
+    "humidifier": {"kp": 6.0, "ki": 0.004, "kd": 0.0, "window": 300},
+}
+
+class PID:
+    """PID à sortie 0-100 %, dérivée sur la mesure (pas d'à-coup au changement de consigne)
+    et anti-windup par intégration conditionnelle : l'intégrale n'avance pas quand la sortie
+    est saturée dans le sens de l'erreur."""
+
+    def __init__(self, kp, ki, kd, out_min=0.0, out_max=100.0):
+        self.kp, self.ki, self.kd = kp, ki, kd
+        self.out_min, self.out_max = out_min, out_max
+        self.reset()
+
+    def reset(self):
+        self.integral = 0.0
+        self.last_time = None
+        self.last_measurement = None
+        self.output = 0.0
+
+    def update(self, setpoint, measurement, now):
+        error = setpoint - measurement
+        dt = now - self.last_time if self.last_time is not None else 0.0
+        derivative = -(measurement - self.last_measurement) / dt if dt > 0 else 0.0
+        proportional = self.kp * error
+        if dt > 0:
+            integral = self.integral + self.ki * error * dt
+            output = proportional + integral + self.kd * derivative
+            if (self.out_min < output < self.out_max or (output >= self.out_max and error < 0)
+                    or (output <= self.out_min and error > 0)):
+                self.integral = integral
+        self.last_time = now
+        self.last_measurement = measurement
+        self.output = min(self.out_max, max(self.out_min, proportional + self.integral + self.kd * derivative))
+        return self.output
+
+class TimeProportional:
+    """Commande d'un relais/SSR tout-ou-rien : allumé `duty` % de chaque fenêtre.
+
+    Le rapport cyclique est figé en début de fenêtre : au plus une commutation ON/OFF par fenêtre."""
+
+    def __init__(self, window):
+        self.window = window
+        self.window_start = None
+        self.duty = 0.0
+
+    def update(self, duty, now):
+        if self.window_start is None or now - self.window_start >= self.window:
+            self.window_start = now
+            self.duty = duty
+        return now - self.window_start < self.window * self.duty / 100
+
+class ChamberController:
+    """Chauffage et humidification d'une chambre : un PID + une sortie proportionnelle au temps chacun."""
+
+    def __init__(self, gains=None):
+        self.configure(gains)
+
+    def configure(self, gains=None):
+        self.gains = {name: {**defaults, **((gains or {}).get(name) or {})}
+            for name, defaults in PID_DEFAULTS.items()}
+        self.pids = {name: PID(g["kp"], g["ki"], g["kd"]) for name, g in self.gains.items()}
+        self.outputs = {name: TimeProportional(g["window"]) for name, g in self.gains.items()}
+
+    def update(self, step, temperature, humidity, now):
+        """Retourne ({actionneur: allumé}, {actionneur: rapport cyclique %})."""
+        duty = {"heater": self.pids["heater"].update(step["temp"], temperature, now)}
+        if humidity is None:
+            # Sans mesure d'humidité, on ne noie pas la chambre à l'aveugle
+            self.pids["humidifier"].reset()
+            duty["humidifier"] = 0.0
+        else:
+            duty["humidifier"] = self.pids["humidifier"].update(step["humidity"], humidity, now)
+        return {name: self.outputs[name].update(duty[name], now) for name in duty}, duty
+
+chamber_controller = ChamberController()
+
+def chamber_temperature(temps):
+    return (temps[0] + temps[1]) / 2 if (temps[0] and temps[1]) else (temps[0] or temps[1] or 22.0)
 
 def control_actuators():
     if not state["batch"]:
+        state["control"] = {"heater": 0.0, "humidifier": 0.0}  # pas de régulation hors batch
         if not state.get("manual_override"):
             for k in state["actuators"]:
-                state["actuators"][k] = False
-                set_relay(k, False)
+                state["actuators"][k] = relays.set(k, False)
         return
     step = state["batch"]["current_step"]
-    temps = state["sensors"]["temperature"]
-    avg_temp = (temps[0] + temps[1]) / 2 if (temps[0] and temps[1]) else (temps[0] or temps[1] or 22.0)
-    state["actuators"]["heater"] = avg_temp < step["temp"] - 0.5
-    state["actuators"]["humidifier"] = state["sensors"]["humidity"] < step["humidity"] - 5
+    avg_temp = chamber_temperature(state["sensors"]["temperature"])
+    outputs, duty = chamber_controller.update(step, avg_temp, state["sensors"]["humidity"], time.monotonic())
+    state["actuators"]["heater"] = outputs["heater"]
+    state["actuators"]["humidifier"] = outputs["humidifier"]
+    state["control"] = {name: round(value, 1) for name, value in duty.items()}
     if step["ventilation"] == "on":
         state["actuators"]["fan_internal"] = True
         state["actuators"]["fan_extract"] = state["mode"] == "dehydrating"
@@ -278,8 +1791,521 @@ def control_actuators():
     else:
         state["actuators"]["fan_internal"] = False
         state["actuators"]["fan_extract"] = False
+    # Le gestionnaire ne touche le GPIO que sur un changement autorisé ; on publie l'état réel
     for k, v in state["actuators"].items():
-        set_relay(k, v)
+        state["actuators"][k] = relays.set(k, v)
+
+# Alertes. Les délais et la tolérance d'humidité viennent de settings.json
+# (temp_alert_delay en minutes, humidity_tolerance en %) ; le reste est fixe.
+ALERT_TEMP_TOLERANCE = 2.0     # °C d'écart à la consigne
+ALERT_TEMP_HYSTERESIS = 0.5    # °C : l'alerte retombe sous tolérance - hystérésis
+ALERT_HUMIDITY_HYSTERESIS = 2.0
+ALERT_FRIDGE_MAX = 5.0         # °C, frigo HACCP
+ALERT_FRIDGE_HYSTERESIS = 0.5
+ALERT_FRIDGE_RATE = 3.0        # °C/h : dérive du frigo (porte ouverte, panne de compresseur)
+ALERT_FRIDGE_RATE_WINDOW = 1800  # s
+ALERT_MISSING_DELAY = 60       # s sans mesure avant l'alerte
+# Sonde figée : une chambre régulée peut rester au dixième près des heures durant, mais pas
+# pendant que le chauffage bascule sans cesse ; le frigo, sans actionneur connu, sur une journée
+ALERT_STUCK_DELAY = 1800       # s minimum de valeur identique (T1, T2)
+ALERT_STUCK_SWITCHES = 10      # commutations du chauffage pendant ce temps
+ALERT_FRIDGE_STUCK_DELAY = 24 * 3600
+ALERT_CLEAR_DELAY = 60         # s de retour à la normale avant de lever l'alerte
+ALERT_WARMUP_FACTOR = 3        # consigne non atteinte après 3 × temp_alert_delay : alerte
+
+class AlertRule:
+    """Déclenchée après `delay` s de condition d'alerte, levée après `clear_delay` s de condition
+    de retour à la normale. Entre les deux seuils (hystérésis en valeur), l'état ne change pas."""
+
+    def __init__(self, delay, clear_delay=ALERT_CLEAR_DELAY):
+        self.delay = delay
+        self.clear_delay = clear_delay
+        self.active = False
+        self.since = None  # début de la condition courante (alerte ou retour à la normale)
+
+    def update(self, now, alarm, normal):
+        """Retourne "raise", "clear" ou None."""
+        pending = normal if self.active else alarm
+        if not pending:
+            self.since = None
+            return None
+        if self.since is None:
+            self.since = now
+        if now - self.since < (self.clear_delay if self.active else self.delay):
+            return None
+        self.active = not self.active
+        self.since = None
+        return "raise" if self.active else "clear"
+
+    def reset(self):
+        self.since = None
+
+class AlertEngine:
+    """Règles évaluées à chaque échantillon, en temps constant : écart à la consigne maintenu,
+    frigo trop chaud ou qui dérive, capteur absent ou figé. Chaque alerte n'est signalée
+    qu'une fois, puis une fois à son retour à la normale."""
+
+    def __init__(self, settings):
+        self.rules = {}
+        self.fridge_window = deque()  # (t, T3) sur ALERT_FRIDGE_RATE_WINDOW
+        self.stuck = {}               # sonde -> [valeur, depuis, commutations du chauffage]
+        self.heater = None
+        self.step_key = None
+        self.step_started = None
+        self.reached = {"temp": False, "humidity": False}
+        self.configure(settings)
+
+    def configure(self, settings):
+        self.delay = setting_number(settings, "temp_alert_delay") * 60
+        self.humidity_tolerance = setting_number(settings, "humidity_tolerance")
+        for key in ("chamber_temp", "chamber_humidity", "fridge_high"):
+            if key in self.rules:
+                self.rules[key].delay = self.delay
+
+    def rule(self, key, delay):
+        if key not in self.rules:
+            self.rules[key] = AlertRule(delay)
+        return self.rules[key]
+
+    def fridge_rate(self, now, value):
+        """Pente (°C/h) de T3 sur la fenêtre glissante ; None tant qu'elle est à moitié vide."""
+        window = self.fridge_window
+        window.append((now, value))
+        while now - window[0][0] > ALERT_FRIDGE_RATE_WINDOW:
+            window.popleft()
+        span = now - window[0][0]
+        if span < ALERT_FRIDGE_RATE_WINDOW / 2:
+            return None
+        return (value - window[0][1]) / span * 3600
+
+    def evaluate(self, now, sensors, missing, step, step_key, heater=False):
+        """Retourne [(clé, "raise" | "clear", texte)] pour cet échantillon."""
+        changes = []
+
+        def check(key, delay, alarm, normal, text):
+            change = self.rule(key, delay).update(now, alarm, normal)
+            if change:
+                changes.append((key, change, text))
+
+        temps = sensors["temperature"]
+        if step_key != self.step_key:
+            # Nouvelle étape : l'écart n'est surveillé qu'une fois la nouvelle consigne atteinte,
+            # ou signalé comme consigne non atteinte après la mise en régime
+            self.step_key = step_key
+            self.step_started = now
+            self.reached = {"temp": False, "humidity": False}
+            for key in ("chamber_temp", "chamber_humidity"):
+                self.rule(key, self.delay).reset()
+        if step is None:
+            # Plus de batch : les alertes liées à la consigne tombent d'elles-mêmes
+            for key in ("chamber_temp", "chamber_humidity", "temp_not_reached", "humidity_not_reached"):
+                if key in self.rules:
+                    self.rules[key].active = False
+                    self.rules[key].reset()
+        else:
+            # Consigne jamais atteinte (chauffage en panne, porte ouverte) : alerte après la mise en régime
+            warmed_up = now - self.step_started >= ALERT_WARMUP_FACTOR * self.delay
+            temp = chamber_temperature(temps)
+            error = abs(temp - step["temp"])
+            self.reached["temp"] |= error <= ALERT_TEMP_TOLERANCE
+            check("temp_not_reached", 0, warmed_up and not self.reached["temp"], self.reached["temp"],
+                f"consigne {step['temp']} °C non atteinte (chambre à {temp:.1f} °C)")
+            if self.reached["temp"]:
+                check("chamber_temp", self.delay, error > ALERT_TEMP_TOLERANCE,
+                    error < ALERT_TEMP_TOLERANCE - ALERT_TEMP_HYSTERESIS,
+                    f"température chambre {temp:.1f} °C (consigne {step['temp']} °C)")
+            hum = sensors["humidity"]
+            if hum is not None:
+                error = abs(hum - step["humidity"])
+                self.reached["humidity"] |= error <= self.humidity_tolerance
+                check("humidity_not_reached", 0, warmed_up and not self.reached["humidity"],
+                    self.reached["humidity"], f"consigne {step['humidity']} % non atteinte (humidité {hum:.0f} %)")
+                if self.reached["humidity"]:
+                    check("chamber_humidity", self.delay, error > self.humidity_tolerance,
+                        error < self.humidity_tolerance - ALERT_HUMIDITY_HYSTERESIS,
+                        f"humidité {hum:.0f} % (consigne {step['humidity']} %)")
+
+        if "t3" not in missing:
+            fridge = temps[2]
+            check("fridge_high", self.delay, fridge > ALERT_FRIDGE_MAX,
+                fridge < ALERT_FRIDGE_MAX - ALERT_FRIDGE_HYSTERESIS, f"frigo à {fridge:.1f} °C")
+            rate = self.fridge_rate(now, fridge)
+            if rate is not None:
+                check("fridge_rising", 0, rate > ALERT_FRIDGE_RATE, rate < ALERT_FRIDGE_RATE / 3,
+                    f"frigo en hausse de {rate:.1f} °C/h")
+
+        for i, label in enumerate(["t1", "t2", "t3"]):
+            absent = label in missing
+            check(f"missing_{label}", ALERT_MISSING_DELAY, absent, not absent, f"sonde {label.upper()} sans mesure")
+            stuck = self.stuck.get(label)
+            if absent or stuck is None or stuck[0] != temps[i]:
+                stuck = self.stuck[label] = [temps[i], now, 0]
+            elif heater != self.heater:
+                stuck[2] += 1
+            if label == "t3":
+                frozen = not absent and now - stuck[1] >= ALERT_FRIDGE_STUCK_DELAY
+            else:
+                frozen = not absent and now - stuck[1] >= ALERT_STUCK_DELAY and stuck[2] >= ALERT_STUCK_SWITCHES
+            check(f"stuck_{label}", 0, frozen, not frozen, f"sonde {label.upper()} figée à {temps[i]} °C")
+        self.heater = heater
+        if sht40.available:
+            absent = sensors["humidity"] is None
+            check("missing_humidity", ALERT_MISSING_DELAY, absent, not absent, "capteur d'humidité sans mesure")
+        if thermocouple is not None:
+            absent = sensors["oven_temp"] is None
+            check("missing_oven", ALERT_MISSING_DELAY, absent, not absent, "thermocouple du four débranché")
+        return changes
+
+    def active(self):
+        return sorted(key for key, rule in self.rules.items() if rule.active)
+
+alert_engine = AlertEngine(load_settings())
+
+def check_alerts():
+    """Évalue les alertes sur le dernier échantillon (appelé sous state_lock, à chaque cycle)."""
+    batch = state["batch"]
+    step = batch["current_step"] if batch else None
+    step_key = (batch["id"], batch["current_step_index"]) if batch else None
+    changes = alert_engine.evaluate(time.monotonic(), state["sensors"], ds18b20_missing, step, step_key,
+        state["actuators"]["heater"])
+    for key, change, text in changes:
+        alert_event(key, change, text)
+    state["alerts"] = alert_engine.active()
+
+def alert_event(key, change, text):
+    """Ajoute l'événement d'une alerte signalée ("raise") ou levée (appelé sous state_lock)."""
+    event = {"time": datetime.now().isoformat(), "alert": key, "level": "alert" if change == "raise" else "info",
+        "text": f"Alerte : {text}" if change == "raise" else f"Fin d'alerte : {text}"}
+    print(event["text"])
+    state["events"].insert(0, event)
+    if state["batch"]:
+        batch_journal.append({"type": "event", "event": event})
+    else:
+        del state["events"][IDLE_EVENTS_MAX:]
+
+def fail_safe(error):
+    """Cycle d'acquisition en échec : chauffage et humidification coupés plutôt que de rester
+    dans leur dernier état (appelé sous state_lock, à chaque cycle en échec)."""
+    for k in ("heater", "humidifier"):
+        state["actuators"][k] = relays.set(k, False, force=True)
+    state["control"] = {"heater": 0.0, "humidifier": 0.0}
+    if "acquisition" not in state["alerts"]:
+        alert_event("acquisition", "raise", f"acquisition en erreur ({error}), chauffage et humidification coupés")
+        state["alerts"] = state["alerts"] + ["acquisition"]
+
+# Analyse des batchs archivés : calculée une fois sur les séries en base, puis gardée avec le
+# batch (colonne analytics) jusqu'à ce qu'il soit réenregistré. Changer le calcul ou la
+# tolérance d'humidité invalide les analyses enregistrées.
+ANALYTICS_VERSION = 2
+ANALYTICS_METRICS = ["temp_in_tolerance", "temp_mean_abs_dev", "temp_overshoot", "humidity_in_tolerance",
+    "humidity_mean_abs_dev", "degree_hours", "heater_duty", "humidifier_duty"]
+ANALYTICS_RAW_GAP = 10  # s : au-delà, un écart entre deux échantillons bruts est un trou d'acquisition
+
+def step_spans(record):
+    """[(indice, début epoch, fin epoch)] des étapes réellement suivies : step_log, ou pour les
+    batchs plus anciens les événements « Étape: » dans l'ordre."""
+    log = record.get("step_log")
+    if not log:
+        changes = sorted(e["time"] for e in record.get("events") or [] if e.get("text", "").startswith("Étape: "))
+        log = [{"index": 0, "at": record["started_at"]}] + [{"index": i + 1, "at": at} for i, at in enumerate(changes)]
+    last = len(record["steps"]) - 1
+    starts = [(min(entry["index"], last), datetime.fromisoformat(entry["at"]).timestamp()) for entry in log]
+    end = datetime.fromisoformat(record.get("ended_at") or log[-1]["at"]).timestamp()
+    return [(index, start, starts[i + 1][1] if i + 1 < len(starts) else end) for i, (index, start) in enumerate(starts)]
+
+def chamber_column(first, second):
+    """Température chambre par point : moyenne de T1 et T2, ou la seule disponible."""
+    return [(a + b) / 2 if a is not None and b is not None else (a if b is None else b) for a, b in zip(first, second)]
+
+def deviation_stats(values, lows, highs, dts, setpoint, tolerance):
+    """Écart à la consigne pondéré par la durée de chaque point ; None sans aucune mesure."""
+    points = [(v - setpoint, lo - setpoint, hi - setpoint, d)
+        for v, lo, hi, d in zip(values, lows, highs, dts) if v is not None]
+    total = sum(p[3] for p in points)
+    if not total:
+        return None
+    return {"setpoint": setpoint,
+        "mean_dev": round(sum(dev * d for dev, _, _, d in points) / total, 2),
+        "mean_abs_dev": round(sum(abs(dev) * d for dev, _, _, d in points) / total, 2),
+        "min_dev": round(min(p[1] for p in points), 2), "max_dev": round(max(p[2] for p in points), 2),
+        "in_tolerance": round(sum(d for dev, _, _, d in points if abs(dev) <= tolerance) / total, 3)}
+
+def duty(values, dts):
+    points = [(v, d) for v, d in zip(values, dts) if v is not None]
+    total = sum(d for _, d in points)
+    return round(sum(v * d for v, d in points) / total, 3) if total else None
+
+def analyze_batch(record, series, humidity_tolerance):
+    """Indicateurs par étape et pour tout le batch, en quelques passes par colonne sur la série
+    archivée (brute ou palier agrégé ; pour un palier, chaque tranche compte pour sa durée et
+    ses min/max donnent les écarts extrêmes)."""
+    result = {"version": ANALYTICS_VERSION, "temp_tolerance": ALERT_TEMP_TOLERANCE,
+        "humidity_tolerance": humidity_tolerance, "tier": record.get("series_tier"), "steps": [],
+        "totals": {m: None for m in ANALYTICS_METRICS}}
+    stamps = series.get("timestamps") or []
+    if not stamps:
+        return result
+    ts = [datetime.fromisoformat(t).timestamp() for t in stamps]
+    period = series.get("period")
+    gap = period or ANALYTICS_RAW_GAP
+    end = datetime.fromisoformat(record["ended_at"]).timestamp() if record.get("ended_at") else ts[-1] + gap
+    dts = [max(0.0, min(b - a, gap)) for a, b in zip(ts, ts[1:] + [end])]
+    lows, highs = series.get("min") or series, series.get("max") or series
+    empty = [None] * len(ts)
+    temp = chamber_column(series.get("t1", empty), series.get("t2", empty))
+    temp_lo = chamber_column(lows.get("t1", empty), lows.get("t2", empty))
+    temp_hi = chamber_column(highs.get("t1", empty), highs.get("t2", empty))
+    hum = series.get("humidity", empty)
+    hum_lo, hum_hi = lows.get("humidity", empty), highs.get("humidity", empty)
+    heater, humidifier = series.get("heater", empty), series.get("humidifier", empty)
+
+    for index, start, stop in step_spans(record):
+        first, last = bisect_left(ts, start), bisect_left(ts, stop)
+        step = record["steps"][index]
+        window = slice(first, last)
+        d = dts[window]
+        stats = {"index": index, "name": step.get("name"), "started_at": datetime.fromtimestamp(start).isoformat(),
+            "duration_h": round((stop - start) / 3600, 2), "covered_h": round(sum(d) / 3600, 2),
+            "temp": deviation_stats(temp[window], temp_lo[window], temp_hi[window], d, step["temp"],
+                ALERT_TEMP_TOLERANCE),
+            "humidity": deviation_stats(hum[window], hum_lo[window], hum_hi[window], d, step["humidity"],
+                humidity_tolerance),
+            "degree_hours": round(sum(v * dt for v, dt in zip(temp[window], d) if v is not None) / 3600, 1)
+                if sum(d) else None,
+            "heater_duty": duty(heater[window], d), "humidifier_duty": duty(humidifier[window], d),
+            "time_to_setpoint_min": None, "overshoot": None}
+        # Dépassement : pic au-dessus de la consigne une fois celle-ci atteinte
+        reached = next((i for i in range(first, last)
+            if temp[i] is not None and abs(temp[i] - step["temp"]) <= ALERT_TEMP_TOLERANCE), None)
+        if reached is not None:
+            stats["time_to_setpoint_min"] = round(max(0.0, ts[reached] - start) / 60, 1)
+            peaks = [v for v in temp_hi[reached:last] if v is not None]
+            stats["overshoot"] = round(max(0.0, max(peaks) - step["temp"]), 2)
+        result["steps"].append(stats)
+
+    def weighted(field, key):
+        pairs = [(s[field][key], s["covered_h"]) for s in result["steps"] if s[field] and s["covered_h"]]
+        total = sum(w for _, w in pairs)
+        return round(sum(v * w for v, w in pairs) / total, 3) if total else None
+
+    def duty_total(key):
+        pairs = [(s[key], s["covered_h"]) for s in result["steps"] if s[key] is not None and s["covered_h"]]
+        total = sum(w for _, w in pairs)
+        return round(sum(v * w for v, w in pairs) / total, 3) if total else None
+
+    overshoots = [s["overshoot"] for s in result["steps"] if s["overshoot"] is not None]
+    degree_hours = [s["degree_hours"] for s in result["steps"] if s["degree_hours"] is not None]
+    result["totals"] = {"temp_in_tolerance": weighted("temp", "in_tolerance"),
+        "temp_mean_abs_dev": weighted("temp", "mean_abs_dev"), "temp_overshoot": max(overshoots, default=None),
+        "humidity_in_tolerance": weighted("humidity", "in_tolerance"),
+        "humidity_mean_abs_dev": weighted("humidity", "mean_abs_dev"),
+        "degree_hours": round(sum(degree_hours), 1) if degree_hours else None,
+        "heater_duty": duty_total("heater_duty"), "humidifier_duty": duty_total("humidifier_duty")}
+    return result
+
+def batch_analytics(batch_id, cached=None):
+    """Analyse d'un batch archivé : celle enregistrée si elle est à jour, sinon calculée puis
+    enregistrée. None si le batch n'existe pas."""
+    cached = cached or batch_repo.cached_analytics(batch_id)
+    tolerance = alert_engine.humidity_tolerance
+    if (cached and cached.get("version") == ANALYTICS_VERSION and cached.get("humidity_tolerance") == tolerance
+            and cached.get("temp_tolerance") == ALERT_TEMP_TOLERANCE):
+        return cached
+    record = batch_repo.get(batch_id)
+    if record is None:
+        return None
+    with metrics.timer("pr_analytics_seconds"):
+        analytics = analyze_batch(record, record.get(BatchRepository.SERIES_KEY) or {}, tolerance)
+    batch_repo.store_analytics(batch_id, analytics)
+    return analytics
+
+def correlation(xs, ys):
+    """Coefficient de Pearson, None à moins de 3 paires ou sans variation."""
+    pairs = [(x, y) for x, y in zip(xs, ys) if x is not None and y is not None]
+    if len(pairs) < 3:
+        return None
+    mx = sum(x for x, _ in pairs) / len(pairs)
+    my = sum(y for _, y in pairs) / len(pairs)
+    sxy = sum((x - mx) * (y - my) for x, y in pairs)
+    sxx = sum((x - mx) ** 2 for x, _ in pairs)
+    syy = sum((y - my) ** 2 for _, y in pairs)
+    if not sxx or not syy:
+        return None
+    return round(sxy / math.sqrt(sxx * syy), 3)
+
+def compare_batches(preset_code):
+    """Indicateurs de tous les batchs d'un préréglage, leur corrélation avec la note (batchs
+    notés seulement) et leur moyenne par statut."""
+    rows = []
+    for summary, cached in batch_repo.preset_analytics(preset_code):
+        analytics = batch_analytics(summary["id"], cached)
+        if analytics is not None:
+            rows.append({**{k: summary.get(k) for k in ("id", "name", "started_at", "status", "rating")},
+                **{m: analytics["totals"].get(m) for m in ANALYTICS_METRICS}})
+    rated = [r for r in rows if r["rating"]]
+    by_status = {}
+    for row in rows:
+        by_status.setdefault(row["status"], []).append(row)
+    return {"preset_code": preset_code, "batches": rows,
+        "correlation": {m: correlation([r[m] for r in rated], [r["rating"] for r in rated]) for m in ANALYTICS_METRICS},
+        "by_status": {status: {"count": len(group), **{m: mean_of([r[m] for r in group]) for m in ANALYTICS_METRICS}}
+            for status, group in by_status.items()}}
+
+def mean_of(values):
+    values = [v for v in values if v is not None]
+    return round(sum(values) / len(values), 3) if values else None
+
+class HaccpStore:
+    """Registre HACCP en ajout seul : un fichier JSON Lines par mois, index par jour en mémoire.
+
+    Chaque relevé est écrit en fin de fichier puis synchronisé (fsync) : une coupure de courant
+    ne peut au pire tronquer que la dernière ligne, ignorée au rechargement. La rétention
+    supprime des fichiers mensuels entiers au lieu de réécrire le registre."""
+
+    def __init__(self, directory, legacy_file=None, retention_days=HACCP_RETENTION_DAYS):
+        self.directory = directory
+        self.legacy_file = legacy_file
+        self.retention_days = retention_days
+        self.lock = threading.Lock()
+        self.months = None  # {"YYYY-MM": {"YYYY-MM-DD": [relevés]}}
+        self.last_day = None
+
+    def month_path(self, month):
+        return os.path.join(self.directory, f"{month}.jsonl")
+
+    def cutoff(self, now=None):
+        return ((now or datetime.now()) - timedelta(days=self.retention_days)).isoformat()
+
+    def index(self, entry):
+        day = entry["time"][:10]
+        self.months.setdefault(day[:7], {}).setdefault(day, []).append(entry)
+
+    def load(self):
+        self.months = {}
+        os.makedirs(self.directory, exist_ok=True)
+        if self.legacy_file and os.path.exists(self.legacy_file):
+            self.migrate(self.legacy_file)
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(".jsonl"):
+                continue
+            path = os.path.join(self.directory, name)
+            with open(path, "rb") as f:
+                content = f.read()
+            if content and not content.endswith(b"\n"):
+                # Dernière ligne tronquée par une coupure : on la retire avant tout nouvel ajout
+                print(f"HACCP: ligne tronquée retirée de {name}")
+                with open(path, "r+b") as f:
+                    f.truncate(content.rfind(b"\n") + 1)
+            for line in content.splitlines(keepends=True):
+                if not line.endswith(b"\n"):
+                    continue
+                try:
+                    self.index(json.loads(line))
+                except (ValueError, KeyError):
+                    print(f"HACCP: ligne ignorée dans {name}")
+        self.compact()
+
+    def ensure_loaded(self):
+        if self.months is None:
+            self.load()
+
+    def migrate(self, legacy_file):
+        with open(legacy_file, "r") as f:
+            entries = json.load(f)
+        by_month = {}
+        for e in entries:
+            by_month.setdefault(e["time"][:7], []).append(e)
+        for month, month_entries in by_month.items():
+            with open(self.month_path(month), "a") as f:
+                for e in month_entries:
+                    f.write(json.dumps(e, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(legacy_file, legacy_file + ".migrated")
+        print(f"HACCP: {len(entries)} relevés migrés depuis {legacy_file}")
+
+    def compact(self, now=None):
+        """Applique la rétention : oublie les jours expirés, supprime les mois entièrement expirés."""
+        cutoff = self.cutoff(now)
+        for month in list(self.months):
+            days = self.months[month]
+            for day in [d for d in days if d < cutoff[:10]]:
+                del days[day]
+            if month < cutoff[:7]:
+                del self.months[month]
+                if os.path.exists(self.month_path(month)):
+                    os.remove(self.month_path(month))
+
+    def append(self, entry):
+        with self.lock:
+            self.ensure_loaded()
+            month_path = self.month_path(entry["time"][:7])
+            created = not os.path.exists(month_path)
+            with open(month_path, "a") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            if created:
+                # Rend la création du fichier elle-même durable
+                dir_fd = os.open(self.directory, os.O_RDONLY)
+                try:
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+            self.index(entry)
+            if entry["time"][:10] != self.last_day:
+                self.last_day = entry["time"][:10]
+                self.compact()
+
+    def day(self, day):
+        with self.lock:
+            self.ensure_loaded()
+            cutoff = self.cutoff()
+            return [e for e in self.months.get(day[:7], {}).get(day, []) if e["time"] > cutoff]
+
+    def month(self, month):
+        with self.lock:
+            self.ensure_loaded()
+            cutoff = self.cutoff()
+            return [e for entries in self.months.get(month, {}).values() for e in entries if e["time"] > cutoff]
+
+    def all(self):
+        with self.lock:
+            self.ensure_loaded()
+            cutoff = self.cutoff()
+            return [e for month in sorted(self.months) for entries in self.months[month].values()
+                for e in entries if e["time"] > cutoff]
+
+    def iter_range(self, start=None, end=None):
+        """Relevés de [start, end[ (ISO 8601), lus ligne à ligne dans les fichiers mensuels :
+        mémoire constante quelle que soit la période, et le verrou n'est pas gardé pendant la
+        lecture (les fichiers ne font que grandir)."""
+        with self.lock:
+            self.ensure_loaded()
+            cutoff = self.cutoff()
+        first = max(start or cutoff, cutoff)
+        months = sorted(name[:-len(".jsonl")] for name in os.listdir(self.directory) if name.endswith(".jsonl"))
+        for month in months:
+            if month < first[:7] or (end and month > end[:7]):
+                continue
+            try:
+                f = open(self.month_path(month), "r")
+            except FileNotFoundError:
+                continue  # mois supprimé par la rétention entre-temps
+            with f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        break  # ajout en cours
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if end and entry["time"] >= end:
+                        break
+                    if entry["time"] > cutoff and (not start or entry["time"] >= start):
+                        yield entry
+
+haccp_store = HaccpStore(HACCP_DIR, legacy_file=HACCP_LOG_FILE)
 
 # HACCP frigo — relevés aux heures fixes (0, 3, 6, 9, 12, 15, 18, 21)
 HACCP_HOURS = [0, 3, 6, 9, 12, 15, 18, 21]
@@ -295,133 +2321,400 @@ def log_haccp(fridge_temp):
     last_haccp_hour = current_hour
     entry = {"time": now.isoformat(), "temp": fridge_temp}
     try:
-        data = load_json(HACCP_LOG_FILE, [])
-        data.append(entry)
-        # Garder 90 jours
-        cutoff = (now - timedelta(days=90)).isoformat()
-        data = [e for e in data if e["time"] > cutoff]
-        save_json(HACCP_LOG_FILE, data)
+        haccp_store.append(entry)
     except Exception as e:
         print(f"HACCP log error: {e}")
 
 def generate_batch_id(preset_code):
-    history = load_history()
-    count = sum(1 for b in history if b.get("preset_code") == preset_code) + 1
-    return f"#{preset_code}-{count:04d}"
-
-@app.route('/')
-def index():
-    return render_template('index.html')
+    return batch_repo.next_batch_id(preset_code)
 
-@app.route('/api/state')
-def get_state():
-    read_sensors()
-    control_actuators()
+def build_snapshot():
+    """Construit l'instantané servi par /api/state (appelé sous state_lock)."""
+    now = datetime.now()
     batch_info = None
     if state["batch"]:
         step = state["batch"]["current_step"]
         step_start = datetime.fromisoformat(state["batch"]["step_started_at"])
-        elapsed_hours = (datetime.now() - step_start).total_seconds() / 3600
+        elapsed_hours = (now - step_start).total_seconds() / 3600
         step_progress = min(100, (elapsed_hours / step["duration"]) * 100)
         total_start = datetime.fromisoformat(state["batch"]["started_at"])
-        total_elapsed = (datetime.now() - total_start).total_seconds() / 3600
+        total_elapsed = (now - total_start).total_seconds() / 3600
         total_progress = min(100, (total_elapsed / state["batch"]["total_duration"]) * 100)
         batch_info = {**state["batch"], "elapsed_hours": round(elapsed_hours, 1),
             "step_progress": round(step_progress, 1), "total_elapsed": round(total_elapsed, 1),
             "total_progress": round(total_progress, 1)}
-    return jsonify({"batch": batch_info, "sensors": state["sensors"], "actuators": state["actuators"],
-        "mode": state["mode"], "events": state["events"][:20], "timestamp": datetime.now().isoformat()})
+    return {"batch": batch_info, "sensors": dict(state["sensors"]), "actuators": dict(state["actuators"]),
+        "mode": state["mode"], "control": dict(state["control"]), "alerts": list(state["alerts"]),
+        "events": list(state["events"][:20]),
+        "timestamp": now.isoformat()}
+
+# Dernier instantané publié : remplacé en bloc, jamais modifié sur place. Les routes le lisent
+# sans verrou ; `snapshot_body` est sa version déjà sérialisée pour /api/state.
+snapshot = None
+snapshot_body = b"null"
+snapshot_version = 0
+snapshot_cond = threading.Condition()  # réveille les flux /api/stream à chaque publication
+
+def publish_snapshot():
+    global snapshot, snapshot_body, snapshot_version
+    # Construction et publication sous le même verrou : deux publications concurrentes
+    # (acquisition, requête) ne peuvent pas se croiser et republier un état plus ancien
+    with state_lock:
+        new_snapshot = build_snapshot()
+        body = json.dumps(new_snapshot, ensure_ascii=False).encode()
+        with snapshot_cond:
+            snapshot = new_snapshot
+            snapshot_body = body
+            snapshot_version += 1
+            snapshot_cond.notify_all()
+
+def acquisition_loop():
+    """Seul propriétaire du matériel : lit les capteurs et pilote les relais à période fixe."""
+    next_tick = time.monotonic()
+    last_start = None
+    while True:
+        started = time.monotonic()
+        if last_start is not None:
+            period = started - last_start
+            metrics.set("pr_control_period_seconds", round(period, 6))
+            metrics.observe("pr_control_jitter_seconds", abs(period - CONTROL_PERIOD))
+        last_start = started
+        # Une lecture en échec ne doit pas figer les relais : la régulation passe en sécurité
+        try:
+            read_sensors()
+            read_error = None
+        except Exception as e:
+            read_error = e
+            print(f"Erreur lecture capteurs: {e}")
+        try:
+            with state_lock:
+                if read_error is None:
+                    if "acquisition" in state["alerts"]:
+                        alert_event("acquisition", "clear", "acquisition rétablie")
+                    check_alerts()
+                    control_actuators()
+                else:
+                    fail_safe(read_error)
+                publish_snapshot()
+                running = state["batch"] is not None
+            write_behind.mark(RELAY_STATS_FILE)
+            if running:
+                write_behind.mark(SERIES_CHECKPOINT_FILE)
+        except Exception as e:
+            print(f"Erreur acquisition: {e}")
+            try:
+                with state_lock:
+                    fail_safe(e)
+                    publish_snapshot()
+            except Exception as e:
+                print(f"Mise en sécurité impossible: {e}")
+        metrics.observe("pr_control_cycle_seconds", time.monotonic() - started)
+        next_tick += CONTROL_PERIOD
+        delay = next_tick - time.monotonic()
+        if delay < 0:
+            # Cycle en retard : on repart de maintenant plutôt que d'enchaîner les rattrapages
+            metrics.inc("pr_control_overruns_total")
+            next_tick = time.monotonic()
+            delay = 0
+        time.sleep(delay)
+
+batch_journal = BatchJournal(BATCH_JOURNAL_FILE)
+
+def series_checkpoint():
+    with state_lock:
+        return {**sensor_series.checkpoint(), "batch": state["batch"]["id"] if state["batch"] else None}
+
+write_behind.register(SERIES_CHECKPOINT_FILE, series_checkpoint, SERIES_CHECKPOINT_INTERVAL)
+
+def resume_batch():
+    """Au démarrage : reprend le batch interrompu (arrêt, coupure, mise à jour) et ses courbes."""
+    try:
+        replay = batch_journal.replay()
+    except Exception as e:
+        print(f"Journal du batch illisible: {e}")
+        replay = None
+    if replay is None:
+        write_behind.discard(SERIES_CHECKPOINT_FILE)  # reste d'un batch déjà archivé
+        return
+    batch, events, buckets = replay
+    checkpoint = load_json(SERIES_CHECKPOINT_FILE, None)
+    if checkpoint and checkpoint.get("batch", batch["id"]) != batch["id"]:
+        checkpoint = None
+    with state_lock:
+        try:
+            sensor_series.restore(checkpoint, buckets)
+        except Exception as e:
+            print(f"Reprise des courbes impossible: {e}")
+            sensor_series.clear()
+        event = {"time": datetime.now().isoformat(), "text": "Reprise après redémarrage"}
+        state["batch"] = batch
+        state["mode"] = "dehydrating" if batch.get("preset") == "dehydrate" else "fermenting"
+        state["events"] = [event] + events
+        try:
+            chamber_controller.configure(validate_pid(batch.get("pid")))
+        except ValueError as e:
+            # Journal écrit avant la validation des gains : on reprend avec les gains par défaut
+            print(f"Gains PID du batch ignorés: {e}")
+            batch["pid"] = None
+            chamber_controller.configure(None)
+        publish_snapshot()
+    batch_journal.append({"type": "event", "event": event})
+    print(f"Batch {batch['id']} repris (étape {batch['current_step_index'] + 1}/{len(batch['steps'])})")
+
+acquisition_thread = None
+def start_acquisition():
+    global acquisition_thread
+    if acquisition_thread is None:
+        resume_batch()
+        write_behind.start()
+        if os.environ.get("PR_PROFILE") == "1":
+            profiler.start()
+        acquisition_thread = threading.Thread(target=acquisition_loop, name="acquisition", daemon=True)
+        acquisition_thread.start()
+
+publish_snapshot()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get("request_started")
+    if started is not None:
+        # Route gabarit (/api/history/<batch_id>) et non chemin réel : nombre de séries borné
+        route = request.url_rule.rule if request.url_rule else "(inconnue)"
+        metrics.observe("pr_http_request_seconds", time.perf_counter() - started, route=route, method=request.method)
+        metrics.inc("pr_http_requests_total", route=route, method=request.method, status=response.status_code)
+    return response
+
+def process_rss():
+    """Mémoire résidente (octets) lue dans /proc ; None hors Linux."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+@app.route('/')
+def index():
+    return render_template('index.html')
+
+@app.route('/metrics')
+def get_metrics():
+    rss = process_rss()
+    if rss is not None:
+        metrics.set("pr_process_resident_memory_bytes", rss)
+    metrics.set("pr_process_threads", threading.active_count())
+    for path in (BATCH_DB_FILE, BATCH_DB_FILE + "-wal", haccp_store.month_path(datetime.now().strftime("%Y-%m"))):
+        if os.path.exists(path):
+            metrics.set("pr_file_size_bytes", os.path.getsize(path), file=os.path.basename(path))
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/api/profiler', methods=['GET', 'POST'])
+def profiler_control():
+    """GET : piles repliées échantillonnées ; POST {"enabled": bool, "reset": bool}."""
+    if request.method == 'POST':
+        data = request.json or {}
+        if data.get("reset"):
+            profiler.reset()
+        if "enabled" in data:
+            profiler.start() if data["enabled"] else profiler.stop()
+        return jsonify({"enabled": profiler.running, "samples": profiler.samples})
+    return Response(profiler.collapsed(), mimetype="text/plain")
+
+@app.route('/api/state')
+def get_state():
+    return Response(snapshot_body, mimetype="application/json")
+
+STREAM_KEEPALIVE = 15  # s ; un commentaire SSE périodique détecte aussi les clients partis
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def snapshot_delta(previous, current):
+    """Événements SSE décrivant ce qui a changé entre deux instantanés."""
+    messages = []
+    for key in ("sensors", "actuators", "mode", "batch", "alerts"):
+        if current[key] != previous[key]:
+            messages.append(sse(key, current[key]))
+    if current["events"] != previous["events"]:
+        # Les événements sont du plus récent au plus ancien : seuls les nouveaux partent
+        last = previous["events"][0] if previous["events"] else None
+        if last is not None and last in current["events"]:
+            messages.append(sse("events", {"new": current["events"][:current["events"].index(last)]}))
+        else:
+            messages.append(sse("events", {"all": current["events"]}))
+    return messages
+
+@app.route('/api/stream')
+def stream_state():
+    """Flux Server-Sent Events : état complet à la connexion, puis uniquement les différences."""
+    def generate():
+        with snapshot_cond:
+            current, version = snapshot, snapshot_version
+        yield "retry: 2000\n" + sse("state", current)
+        while True:
+            with snapshot_cond:
+                snapshot_cond.wait_for(lambda: snapshot_version != version, timeout=STREAM_KEEPALIVE)
+                latest, latest_version = snapshot, snapshot_version
+            if latest_version == version:
+                yield ": keepalive\n\n"
+                continue
+            messages = snapshot_delta(current, latest)
+            current, version = latest, latest_version
+            if messages:
+                yield "".join(messages)
+    return Response(generate(), mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# Fenêtres d'affichage du graphe (secondes) ; "batch" = depuis le début du batch en cours
+SENSOR_WINDOWS = {"1m": 60, "15m": 900, "1h": 3600, "6h": 6 * 3600, "24h": 86400, "7d": 7 * 86400,
+    "30d": 30 * 86400}
+GRAPH_POINTS = 60
+GRAPH_POINTS_MAX = 2000
+SERIES_AGGREGATIONS = ("mean", "minmax", "lttb")
+
+def parse_time(value):
+    """Horodatage en secondes epoch ou ISO 8601 -> secondes epoch."""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
 
 @app.route('/api/sensors/history')
 def get_sensor_history():
-    interval = request.args.get('interval', '1m')
-    # Calculer le pas d'échantillonnage
-    if interval == '15m':
-        step = 15
-    elif interval == '1h':
-        step = 60
-    else:
-        step = 1
-    
-    timestamps = list(sensor_history["timestamps"])
-    t1 = list(sensor_history["t1"])
-    t2 = list(sensor_history["t2"])
-    t3 = list(sensor_history["t3"])
-    humidity = list(sensor_history["humidity"])
-    oven = list(sensor_history["oven"])
-    
-    # Sous-échantillonner
-    if step > 1 and len(timestamps) > step:
-        timestamps = timestamps[::step]
-        t1 = t1[::step]
-        t2 = t2[::step]
-        t3 = t3[::step]
-        humidity = humidity[::step]
-        oven = oven[::step]
-    
-    return jsonify({
-        "timestamps": timestamps[-60:],  # 60 derniers points
-        "t1": t1[-60:],
-        "t2": t2[-60:],
-        "t3": t3[-60:],
-        "humidity": humidity[-60:],
-        "oven": oven[-60:]
-    })
+    """Courbes capteurs : ?interval= ou ?from=&to=, ?points=N, ?agg=mean|minmax|lttb (&channel= pour lttb)."""
+    args = request.args
+    try:
+        t_to = parse_time(args['to']) if 'to' in args else time.time()
+        if 'from' in args:
+            t_from = parse_time(args['from'])
+        elif args.get('interval') == 'batch':
+            with state_lock:
+                started_at = state["batch"]["started_at"] if state["batch"] else None
+            t_from = datetime.fromisoformat(started_at).timestamp() if started_at else t_to - 3600
+        else:
+            t_from = t_to - SENSOR_WINDOWS.get(args.get('interval', '1m'), 60)
+        points = max(2, min(int(args.get('points', GRAPH_POINTS)), GRAPH_POINTS_MAX))
+    except (ValueError, TypeError):
+        return jsonify({"error": "Paramètres invalides"}), 400
+    agg = args.get('agg', 'mean')
+    channel = args.get('channel', 't1')
+    if agg not in SERIES_AGGREGATIONS or channel not in SERIES_CHANNELS or t_from >= t_to:
+        return jsonify({"error": "Paramètres invalides"}), 400
+    with state_lock:
+        # Copie de la fenêtre sous verrou ; l'agrégation se fait sans bloquer l'acquisition
+        source = sensor_series.coverage_tier(t_from)
+        ts, columns = sensor_series.rows(source, t_from, t_to)
+    return jsonify({**downsample(ts, columns, t_from, t_to, points, agg, channel), "source": source})
+
+@app.route('/api/sensors/sht40', methods=['GET', 'POST'])
+def sht40_settings():
+    if request.method == 'POST':
+        data = request.json or {}
+        try:
+            sht40.set_mode(data.get('mode', ''))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except Exception as e:
+            return jsonify({"error": f"SHT40: {e}"}), 503
+    return jsonify(sht40.status())
 
 @app.route('/api/presets')
 def get_presets():
-    return jsonify(get_all_presets())
+    body, etag = preset_registry.payload()
+    response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    return response.make_conditional(request)
 
 @app.route('/api/presets/custom', methods=['POST'])
 def create_custom_preset():
-    data = request.json
-    custom = load_custom_presets()
+    data = request.json or {}
     key = data.get('key') or f"custom_{int(time.time())}"
-    custom[key] = {"name": data.get('name', 'Sans nom'), "icon": "C", "code": "CU",
-        "parent": data.get('parent'), "steps": data.get('steps', []), "created_at": datetime.now().isoformat()}
-    save_custom_presets(custom)
+    if key in SYSTEM_PRESETS:
+        return jsonify({"error": "Préréglage système"}), 400
+    preset = {"name": data.get('name', 'Sans nom'), "icon": "C", "code": "CU", "parent": data.get('parent'),
+        "steps": data.get('steps', []), "created_at": datetime.now().isoformat()}
+    if data.get('pid') is not None:
+        preset["pid"] = data['pid']
+    try:
+        preset_registry.save(key, preset)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     return jsonify({"success": True, "key": key})
 
 @app.route('/api/presets/custom/<key>', methods=['DELETE'])
 def delete_custom_preset(key):
-    custom = load_custom_presets()
-    if key in custom:
-        del custom[key]
-        save_custom_presets(custom)
+    if preset_registry.delete(key):
         return jsonify({"success": True})
     return jsonify({"error": "Non trouvé"}), 404
 
+HISTORY_PAGE_DEFAULT = 50
+HISTORY_PAGE_MAX = 200
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+def decode_cursor(cursor):
+    started_at, batch_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return started_at, batch_id
+
 @app.route('/api/history')
 def get_history():
-    history = load_history()
-    history.sort(key=lambda x: x.get('started_at', ''), reverse=True)
-    return jsonify(history)
+    """Liste paginée de résumés ; le détail complet (séries comprises) est sur /api/history/<id>."""
+    try:
+        limit = max(1, min(int(request.args.get('limit', HISTORY_PAGE_DEFAULT)), HISTORY_PAGE_MAX))
+        cursor = request.args.get('cursor')
+        after = decode_cursor(cursor) if cursor else None
+    except (ValueError, TypeError):
+        return jsonify({"error": "Paramètres invalides"}), 400
+    items, next_key = batch_repo.summaries(limit, after, request.args.get('preset'), request.args.get('status'))
+    response = jsonify({"items": items, "next_cursor": encode_cursor(next_key) if next_key else None})
+    response.add_etag()
+    return response.make_conditional(request)
 
 @app.route('/api/history/<batch_id>', methods=['GET'])
 def get_history_item(batch_id):
-    for h in load_history():
-        if h.get('id') == batch_id:
-            return jsonify(h)
-    return jsonify({"error": "Non trouvé"}), 404
+    record = batch_repo.get(batch_id, tier=request.args.get('tier'))
+    if record is None:
+        return jsonify({"error": "Non trouvé"}), 404
+    return jsonify(record)
+
+@app.route('/api/history/<batch_id>/analytics')
+def get_history_analytics(batch_id):
+    analytics = batch_analytics(batch_id)
+    if analytics is None:
+        return jsonify({"error": "Non trouvé"}), 404
+    return jsonify(analytics)
+
+@app.route('/api/analytics')
+def get_analytics():
+    """Comparaison des batchs d'un préréglage : ?preset=<code> (T, K…)."""
+    preset_code = request.args.get('preset')
+    if not preset_code:
+        return jsonify({"error": "Paramètre preset manquant"}), 400
+    response = jsonify(compare_batches(preset_code))
+    response.add_etag()
+    return response.make_conditional(request)
 
 @app.route('/api/history/<batch_id>', methods=['DELETE'])
 def delete_history_item(batch_id):
-    history = [h for h in load_history() if h.get('id') != batch_id]
-    save_history(history)
+    batch_repo.delete(batch_id)
     return jsonify({"success": True})
 
 @app.route('/api/history/<batch_id>/rating', methods=['POST'])
 def rate_history_item(batch_id):
     data = request.json
-    history = load_history()
-    for h in history:
-        if h.get('id') == batch_id:
-            h['rating'] = data.get('rating', 0)
-            h['status'] = data.get('status', h.get('status'))
-            h['notes'] = data.get('notes', h.get('notes', ''))
-            save_history(history)
-            return jsonify({"success": True})
-    return jsonify({"error": "Non trouvé"}), 404
+    record = batch_repo.get(batch_id, with_series=False)
+    if record is None:
+        return jsonify({"error": "Non trouvé"}), 404
+    batch_repo.update(batch_id, {"rating": data.get('rating', 0), "status": data.get('status', record.get('status')),
+        "notes": data.get('notes', record.get('notes', ''))})
+    return jsonify({"success": True})
 
 @app.route('/api/batch/start', methods=['POST'])
 def start_batch():
@@ -430,85 +2723,129 @@ def start_batch():
     preset_key = data.get('preset')
     preset_code = data.get('code', 'X')
     preset_name = data.get('name', 'Manuel')
+    preset = preset_registry.get(preset_key) if preset_key else None
     if not steps and preset_key:
-        preset = get_all_presets().get(preset_key)
         if not preset:
             return jsonify({"error": "Preset inconnu"}), 400
         steps = preset["steps"]
         preset_code = preset["code"]
         preset_name = preset["name"]
-    if not steps:
-        return jsonify({"error": "Aucune étape"}), 400
+    else:
+        # Profil modifié dans l'interface : mêmes contrôles qu'à l'enregistrement d'un préréglage
+        try:
+            steps = validate_steps(steps)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
     batch_id = generate_batch_id(preset_code)
+    try:
+        pid_gains = validate_pid(data.get('pid') or (preset or {}).get("pid"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     now = datetime.now()
-    state["batch"] = {"id": batch_id, "name": data.get('name', preset_name), "preset": preset_key,
-        "preset_code": preset_code, "steps": steps, "current_step_index": 0, "current_step": steps[0],
-        "started_at": now.isoformat(), "step_started_at": now.isoformat(),
-        "total_duration": sum(s["duration"] for s in steps)}
-    state["mode"] = "dehydrating" if preset_key == "dehydrate" else "fermenting"
-    state["events"] = [{"time": now.isoformat(), "text": f"Démarrage {preset_name}"}]
-    return jsonify({"success": True, "batch": state["batch"]})
+    with state_lock:
+        state["batch"] = {"id": batch_id, "name": data.get('name', preset_name), "preset": preset_key,
+            "preset_code": preset_code, "steps": steps, "current_step_index": 0, "current_step": steps[0],
+            "started_at": now.isoformat(), "step_started_at": now.isoformat(),
+            "step_log": [{"index": 0, "at": now.isoformat()}],
+            "total_duration": sum(s["duration"] for s in steps), "pid": pid_gains}
+        chamber_controller.configure(pid_gains)
+        # Les courbes du batch partent de son démarrage, sans les jours d'inactivité qui précèdent
+        sensor_series.clear()
+        state["mode"] = "dehydrating" if preset_key == "dehydrate" else "fermenting"
+        state["events"] = [{"time": now.isoformat(), "text": f"Démarrage {preset_name}"}]
+        batch_journal.start(state["batch"], state["events"])
+        publish_snapshot()
+        return jsonify({"success": True, "batch": state["batch"]})
 
 @app.route('/api/batch/stop', methods=['POST'])
 def stop_batch():
     data = request.json or {}
-    if state["batch"]:
-        history = load_history()
-        # Sauvegarder l'historique des capteurs avec le batch
-        batch_sensor_history = {
-            "timestamps": list(sensor_history["timestamps"]),
-            "t1": list(sensor_history["t1"]),
-            "t2": list(sensor_history["t2"]),
-            "t3": list(sensor_history["t3"]),
-            "humidity": list(sensor_history["humidity"]),
-            "oven": list(sensor_history["oven"])
-        }
-        history.insert(0, {**state["batch"], "ended_at": datetime.now().isoformat(),
+    with state_lock:
+        if not state["batch"]:
+            return jsonify({"success": True})
+        # Sauvegarder l'historique des capteurs avec le batch, à toutes les résolutions
+        started = datetime.fromisoformat(state["batch"]["started_at"]).timestamp()
+        series = sensor_series.export()
+        record = {**state["batch"], "ended_at": datetime.now().isoformat(),
             "events": state["events"], "status": data.get('status', 'completed'),
             "rating": data.get('rating', 0), "notes": data.get('notes', ''),
-            "sensor_history": batch_sensor_history})
-        save_history(history)
+            "series_tier": sensor_series.coverage_tier(started)}
         state["batch"] = None
         state["mode"] = "idle"
         state["events"] = []
         # Vider l'historique des capteurs pour le prochain batch
-        for key in sensor_history:
-            sensor_history[key].clear()
+        sensor_series.clear()
+        publish_snapshot()
+    batch_repo.insert(record, series)
+    # Le batch est en base : plus rien à rejouer, ni journal ni point de reprise des courbes
+    batch_journal.clear()
+    write_behind.discard(SERIES_CHECKPOINT_FILE)
     return jsonify({"success": True})
 
 @app.route('/api/batch/next-step', methods=['POST'])
 def next_step():
-    if not state["batch"]:
-        return jsonify({"error": "Aucun batch"}), 400
-    idx = state["batch"]["current_step_index"]
-    steps = state["batch"]["steps"]
-    if idx + 1 >= len(steps):
-        return jsonify({"error": "Dernière étape"}), 400
-    state["batch"]["current_step_index"] = idx + 1
-    state["batch"]["current_step"] = steps[idx + 1]
-    state["batch"]["step_started_at"] = datetime.now().isoformat()
-    state["events"].insert(0, {"time": datetime.now().isoformat(), "text": f"Étape: {steps[idx + 1]['name']}"})
-    return jsonify({"success": True, "step": state["batch"]["current_step"]})
+    with state_lock:
+        if not state["batch"]:
+            return jsonify({"error": "Aucun batch"}), 400
+        idx = state["batch"]["current_step_index"]
+        steps = state["batch"]["steps"]
+        if idx + 1 >= len(steps):
+            return jsonify({"error": "Dernière étape"}), 400
+        state["batch"]["current_step_index"] = idx + 1
+        state["batch"]["current_step"] = steps[idx + 1]
+        state["batch"]["step_started_at"] = datetime.now().isoformat()
+        state["batch"].setdefault("step_log", []).append({"index": idx + 1, "at": state["batch"]["step_started_at"]})
+        event = {"time": datetime.now().isoformat(), "text": f"Étape: {steps[idx + 1]['name']}"}
+        state["events"].insert(0, event)
+        batch_journal.append({"type": "step", "index": idx + 1, "at": state["batch"]["step_started_at"]})
+        batch_journal.append({"type": "event", "event": event})
+        publish_snapshot()
+        return jsonify({"success": True, "step": state["batch"]["current_step"]})
 
 @app.route('/api/batch/event', methods=['POST'])
 def add_event():
     data = request.json
     event = {"time": datetime.now().isoformat(), "text": data.get('text', '')}
-    state["events"].insert(0, event)
+    with state_lock:
+        state["events"].insert(0, event)
+        if state["batch"]:
+            batch_journal.append({"type": "event", "event": event})
+        else:
+            del state["events"][IDLE_EVENTS_MAX:]
+        publish_snapshot()
     return jsonify({"success": True, "event": event})
 
 @app.route('/api/actuator/<name>', methods=['POST'])
 def toggle_actuator(name):
     if name in state["actuators"]:
         data = request.json or {}
-        state["actuators"][name] = data.get('state', not state["actuators"][name])
-        set_relay(name, state["actuators"][name])
-        # Activer mode manuel si pas de batch
-        if not state["batch"]:
-            state["manual_override"] = any(state["actuators"].values())
-        return jsonify({"success": True, "state": state["actuators"][name]})
+        with state_lock:
+            wanted = bool(data.get('state', not state["actuators"][name]))
+            state["actuators"][name] = relays.set(name, wanted)
+            # Activer mode manuel si pas de batch
+            if not state["batch"]:
+                state["manual_override"] = any(state["actuators"].values())
+            publish_snapshot()
+            if state["actuators"][name] != wanted:
+                # Temps minimum ON/OFF pas encore écoulé
+                return jsonify({"success": False, "state": state["actuators"][name],
+                    "retry_in": relays.report()[name]["retry_in"]}), 409
+            return jsonify({"success": True, "state": state["actuators"][name]})
     return jsonify({"error": "Inconnu"}), 400
 
+@app.route('/api/relays')
+def get_relays():
+    return jsonify(relays.report())
+
+@app.route('/api/relays/<name>/reset', methods=['POST'])
+def reset_relay_stats(name):
+    if name not in RELAY_PINS:
+        return jsonify({"error": "Inconnu"}), 400
+    relays.reset(name)
+    write_behind.mark(RELAY_STATS_FILE)
+    write_behind.flush(RELAY_STATS_FILE)
+    return jsonify({"success": True})
+
 @app.route('/api/pwm/<name>', methods=['POST'])
 def set_pwm(name):
     data = request.json or {}
@@ -524,7 +2861,13 @@ def set_pwm(name):
 @app.route('/api/settings', methods=['GET', 'POST'])
 def settings():
     if request.method == 'POST':
-        save_settings(request.json)
+        try:
+            data = validate_settings(request.get_json(silent=True))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        save_settings(data)
+        with state_lock:
+            alert_engine.configure(load_settings())
         return jsonify({"success": True})
     return jsonify(load_settings())
 
@@ -532,19 +2875,150 @@ def settings():
 def quit_app():
     import subprocess
     subprocess.Popen(['pkill', '-f', 'chromium.*localhost:5000'])
+    write_behind.flush()
     os._exit(0)
     return jsonify({"success": True})
 
 @app.route('/api/haccp')
 def get_haccp():
-    data = load_json(HACCP_LOG_FILE, [])
     day = request.args.get('day')  # format YYYY-MM-DD
-    if day:
-        data = [e for e in data if e["time"].startswith(day)]
     month = request.args.get('month')  # format YYYY-MM
-    if month:
-        data = [e for e in data if e["time"].startswith(month)]
+    if day:
+        data = haccp_store.day(day)
+        if month:
+            data = [e for e in data if e["time"].startswith(month)]
+    elif month:
+        data = haccp_store.month(month)
+    else:
+        data = haccp_store.all()
     return jsonify(data)
 
+# Exports en flux (CSV ou NDJSON) : les lignes sont produites à la demande et envoyées par
+# morceaux, sans verrou d'état ; un export occupe un thread de requêtes le temps du transfert.
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+EXPORT_CHUNK = 64 * 1024  # caractères par morceau envoyé
+
+def export_response(rows, columns, fmt, filename):
+    """Réponse en flux : `rows` (itérable de dicts) en CSV (colonnes `columns`) ou NDJSON."""
+    def generate():
+        buffer = io.StringIO()
+        if fmt == "csv":
+            writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction="ignore")
+            writer.writeheader()
+            write = writer.writerow
+        else:
+            write = lambda row: buffer.write(json.dumps(row, ensure_ascii=False) + "\n")
+        for row in rows:
+            write(row)
+            if buffer.tell() >= EXPORT_CHUNK:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    return Response(generate(), mimetype=EXPORT_FORMATS[fmt], headers={
+        "Content-Disposition": f'attachment; filename="{filename}.{fmt}"', "X-Accel-Buffering": "no"})
+
+def export_args():
+    """(format, début ISO ou None, fin ISO ou None) depuis ?format=&from=&to= ; ValueError si invalide."""
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(fmt)
+    bounds = [datetime.fromtimestamp(parse_time(request.args[k])).isoformat() if request.args.get(k) else None
+        for k in ('from', 'to')]
+    return fmt, bounds[0], bounds[1]
+
+@app.route('/api/export/haccp')
+def export_haccp():
+    """Registre HACCP : ?format=csv|ndjson&from=&to= (ISO 8601 ou epoch, `to` exclu)."""
+    try:
+        fmt, t_from, t_to = export_args()
+    except (ValueError, TypeError):
+        return jsonify({"error": "Paramètres invalides"}), 400
+    return export_response(haccp_store.iter_range(t_from, t_to), ["time", "temp"], fmt, "haccp")
+
+@app.route('/api/export/batches')
+def export_batches():
+    """Résumés des batchs démarrés dans [from, to[ : ?format=&from=&to=&preset=&status=."""
+    try:
+        fmt, t_from, t_to = export_args()
+    except (ValueError, TypeError):
+        return jsonify({"error": "Paramètres invalides"}), 400
+    rows = batch_repo.iter_summaries(t_from, t_to, request.args.get('preset'), request.args.get('status'))
+    return export_response(rows, BatchRepository.SUMMARY_FIELDS + ["step_count", "event_count"], fmt, "batchs")
+
+@app.route('/api/export/series')
+def export_series():
+    """Courbes archivées, un point par ligne : ?batch=<id> ou ?preset=<code>&from=&to= (batchs
+    démarrés dans la période, points limités à la période), ?tier= pour un palier précis
+    (par défaut le plus fin couvrant chaque batch). Un seul batch en mémoire à la fois."""
+    try:
+        fmt, t_from, t_to = export_args()
+    except (ValueError, TypeError):
+        return jsonify({"error": "Paramètres invalides"}), 400
+    tier = request.args.get('tier')
+    if tier and tier != "raw" and tier not in {name for name, _, _ in SERIES_TIERS}:
+        return jsonify({"error": "Palier inconnu"}), 400
+    batch_id = request.args.get('batch')
+    if batch_id:
+        record = batch_repo.get(batch_id, with_series=False)
+        if record is None:
+            return jsonify({"error": "Non trouvé"}), 404
+        batches = [record]
+    else:
+        # Les bornes filtrent les points ; un batch démarré avant `from` peut encore en avoir
+        batches = batch_repo.iter_summaries(None, t_to, request.args.get('preset'), request.args.get('status'))
+
+    def rows():
+        for batch in batches:
+            if t_from and (batch.get("ended_at") or "9999") < t_from:
+                continue
+            batch_tier = tier or batch_repo.get(batch["id"], with_series=False).get("series_tier", "raw")
+            series = batch_repo.series(batch["id"], batch_tier)
+            if not series:
+                continue
+            for i, timestamp in enumerate(series["timestamps"]):
+                if (t_from and timestamp < t_from) or (t_to and timestamp >= t_to):
+                    continue
+                row = {"batch_id": batch["id"], "tier": batch_tier, "timestamp": timestamp}
+                for channel in SERIES_CHANNELS:
+                    column = series.get(channel)
+                    row[channel] = column[i] if column else None
+                yield row
+    return export_response(rows(), ["batch_id", "tier", "timestamp"] + SERIES_CHANNELS, fmt, "courbes")
+
+# Serveur HTTP : PR_SERVER=waitress | cheroot | dev (défaut : waitress, sinon cheroot, sinon Werkzeug).
+# Chaque flux /api/stream occupe un thread : PR_THREADS doit couvrir kiosque + clients ouverts.
+SERVER_THREADS = int(os.environ.get("PR_THREADS", "8"))
+HTTP_PORT = int(os.environ.get("PR_PORT", "5000"))
+
+def serve(host="0.0.0.0", port=HTTP_PORT):
+    server = os.environ.get("PR_SERVER", "auto")
+    if server in ("auto", "waitress"):
+        try:
+            from waitress import serve as waitress_serve
+        except ImportError:
+            print("waitress non disponible")
+        else:
+            print(f"Serveur waitress ({SERVER_THREADS} threads) sur {host}:{port}")
+            waitress_serve(app, host=host, port=port, threads=SERVER_THREADS, ident="protein-resequencer")
+            return
+    if server in ("auto", "waitress", "cheroot"):
+        try:
+            from cheroot.wsgi import Server
+        except ImportError:
+            print("cheroot non disponible")
+        else:
+            print(f"Serveur cheroot ({SERVER_THREADS} threads) sur {host}:{port}")
+            httpd = Server((host, port), app, numthreads=SERVER_THREADS, server_name="protein-resequencer")
+            try:
+                httpd.start()
+            except KeyboardInterrupt:
+                httpd.stop()
+            return
+    # Serveur de développement Werkzeug ; le débogueur interactif seulement si demandé explicitement
+    print(f"Serveur de développement sur {host}:{port}")
+    app.run(host=host, port=port, debug=(server == "dev"), threaded=True, use_reloader=False)
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False)
+    start_acquisition()
+    serve()
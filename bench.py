@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+Protein Resequencer - Bancs d'essai
+Mesure latence et débit de /api/state, /api/sensors/history, /api/history, /api/haccp et
+/api/analytics sur des jeux de données synthétiques (un an de relevés HACCP, plusieurs
+centaines de batchs archivés avec leurs courbes complètes, 30 jours de courbes en cours),
+avec le matériel simulé de hwsim.py : aucun Pi, aucun réseau.
+
+Les durées sont aussi exprimées relativement à une boucle de calibration en pur Python,
+ce qui rend la comparaison avec la référence (bench_baseline.json) valable d'une
+machine x86 à l'autre ; une régression au-delà du seuil fait échouer la commande.
+Chaque cas est mesuré en plusieurs tours entrelacés, chacun ramené à sa propre
+calibration ; un écart de l'ordre de la dispersion observée entre tours n'est pas une
+régression.
+
+Usage :
+    python3 bench.py                     # mesure et compare à bench_baseline.json
+    python3 bench.py --save              # enregistre la référence
+    python3 bench.py --batches 300 --threshold 0.3 --json resultats.json
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BASELINE_FILE = os.path.join(ROOT, "bench_baseline.json")
+SEED = 42
+# En dessous de cet écart (en unités de calibration, ≈ 0,4 ms sur un PC), la variation est du bruit
+NOISE_FLOOR = 0.005
+# Un écart n'est retenu que s'il dépasse aussi NOISE_SPREAD fois la dispersion mesurée entre tours
+NOISE_SPREAD = 3
+# Cas très courts (médiane sous SMALL_CASE_MS) : tolérance doublée, le bruit y pèse plus lourd
+SMALL_CASE_MS = 2.0
+
+def calibrate(rounds=3):
+    """Durée médiane (s) d'une charge fixe représentative : dictionnaires, flottants, JSON.
+    Refaite à chaque tour de mesure, elle suit les variations de vitesse de la machine
+    (fréquence, voisins sur une VM) pendant le banc."""
+    def workload():
+        rows = [{"t": i, "v": math.sin(i / 50.0) * 10 + 25} for i in range(20000)]
+        rows.sort(key=lambda r: r["v"])
+        json.dumps(rows)
+    times = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        workload()
+        times.append(time.perf_counter() - started)
+    return statistics.median(times)
+
+def write_haccp_year(directory, end, rng):
+    """Un an de relevés au rythme de HACCP_HOURS, en fichiers mensuels comme HaccpStore."""
+    import app
+    os.makedirs(directory, exist_ok=True)
+    by_month = {}
+    day = end - timedelta(days=365)
+    while day <= end:
+        for hour in app.HACCP_HOURS:
+            t = day.replace(hour=hour, minute=0, second=0, microsecond=0)
+            by_month.setdefault(t.strftime("%Y-%m"), []).append(
+                {"time": t.isoformat(), "temp": round(3.5 + rng.random(), 1)})
+        day += timedelta(days=1)
+    for month, entries in by_month.items():
+        with open(os.path.join(directory, f"{month}.jsonl"), "w") as f:
+            f.writelines(json.dumps(e) + "\n" for e in entries)
+    return sum(len(e) for e in by_month.values())
+
+def fill_live_series(series, end, rng, days=30):
+    """Courbes en cours : une valeur par minute sur `days` jours puis la dernière heure à 2 s."""
+    start = end - timedelta(days=days)
+    t = start
+    while t < end - timedelta(hours=1):
+        series.append(t, synthetic_sample(t, rng))
+        t += timedelta(minutes=1)
+    while t < end:
+        series.append(t, synthetic_sample(t, rng))
+        t += timedelta(seconds=2)
+
+def synthetic_sample(t, rng):
+    base = 30 + 2 * math.sin(t.timestamp() / 3600)
+    return {"t1": round(base + rng.uniform(-0.2, 0.2), 2), "t2": round(base + 0.3 + rng.uniform(-0.2, 0.2), 2),
+        "t3": round(4 + rng.uniform(-0.3, 0.3), 2), "humidity": round(75 + rng.uniform(-3, 3), 1),
+        "oven": None, "heater": float(rng.random() < 0.4), "humidifier": float(rng.random() < 0.2)}
+
+def archived_series(app, hours, started, rng):
+    """Séries d'un batch archivé, au format de SensorSeries.export()."""
+    series = app.SensorSeries()
+    t = datetime.fromisoformat(started)
+    end = t + timedelta(hours=hours)
+    # Une valeur par minute suffit à remplir les paliers ; la dernière heure brute à 30 s
+    while t < end:
+        series.append(t, synthetic_sample(t, rng))
+        t += timedelta(minutes=1 if end - t > timedelta(hours=1) else 0.5)
+    return series.export(), series.coverage_tier(series.first_ts)
+
+def store_batches(app, count, end, rng, rounds=1):
+    """Archive `count` batchs en `rounds` tours, chacun précédé d'une calibration ;
+    retourne ([durées des insertions (s)] par tour, [calibration] par tour)."""
+    presets = [p for key, p in app.SYSTEM_PRESETS.items() if key != "manual"]
+    templates = {}
+    times, calibrations = [], []
+    per_round = -(-count // rounds)
+    for i in range(count):
+        if i % per_round == 0:
+            calibrations.append(calibrate())
+            times.append([])
+        preset = presets[i % len(presets)]
+        hours = sum(s["duration"] for s in preset["steps"])
+        started = (end - timedelta(days=2 * (count - i))).replace(microsecond=0).isoformat()
+        if preset["code"] not in templates:
+            # Même forme de courbe pour tous les batchs d'un préréglage : seule la génération est mise en commun
+            templates[preset["code"]] = archived_series(app, hours, started, rng)
+        series, tier = templates[preset["code"]]
+        record = {"id": f"#{preset['code']}-{i + 1:04d}", "name": preset["name"], "preset": None,
+            "preset_code": preset["code"], "steps": preset["steps"], "current_step_index": len(preset["steps"]) - 1,
+            "current_step": preset["steps"][-1], "started_at": started, "step_started_at": started,
+            "ended_at": (datetime.fromisoformat(started) + timedelta(hours=hours)).isoformat(),
+            "total_duration": hours, "events": [{"time": started, "text": f"Démarrage {preset['name']}"}],
+            "status": "completed" if i % 7 else "failed", "rating": i % 6, "notes": "", "series_tier": tier}
+        started = time.perf_counter()
+        app.batch_repo.insert(record, series)
+        times[-1].append(time.perf_counter() - started)
+    return times, calibrations
+
+def measure_round(client, url, iterations):
+    """Un tour de `iterations` requêtes : (durées en s, taille de la réponse)."""
+    times = []
+    size = 0
+    for _ in range(iterations):
+        started = time.perf_counter()
+        response = client.get(url)
+        times.append(time.perf_counter() - started)
+        if response.status_code != 200:
+            raise RuntimeError(f"{url}: HTTP {response.status_code}")
+        size = len(response.data)
+    return times, size
+
+def summarize(rounds, calibrations, size=None):
+    """Médiane des tours, chacun ramené à la calibration faite juste avant lui, et dispersion
+    entre tours (écart absolu médian × 1,4826, un écart-type qu'un tour aberrant ne gonfle pas),
+    en unités de calibration ; rounds = [durées (s)] par tour."""
+    medians = [statistics.median(times) for times in rounds]
+    relatives = [m / c for m, c in zip(medians, calibrations)]
+    times = sorted(t for r in rounds for t in r)
+    center = statistics.median(relatives)
+    spread = 1.4826 * statistics.median(abs(r - center) for r in relatives)
+    result = {"median_ms": round(statistics.median(medians) * 1000, 3),
+        "relative": round(center, 4), "spread": round(spread, 4)}
+    if size is not None:
+        result.update({"p95_ms": round(times[min(len(times) - 1, int(len(times) * 0.95))] * 1000, 3),
+            "req_s": round(len(times) / sum(times), 1), "bytes": size})
+    return result
+
+def run(args):
+    rng = random.Random(SEED)
+    workdir = tempfile.mkdtemp(prefix="pr-bench-")
+    os.chdir(workdir)
+    os.environ["PR_FAKE_HARDWARE"] = "1"
+    os.environ["PR_W1_PATH"] = os.path.join(workdir, "w1")
+    sys.path.insert(0, ROOT)
+    import app
+    end = datetime.now()
+    results = {}
+    calibrations = []
+
+    # Chargement complet : relecture, index par jour et rétention (les mois expirés sont supprimés,
+    # d'où la réécriture de l'année avant chaque mesure)
+    load_times, load_calibrations = [], []
+    for _ in range(args.rounds):
+        entries = write_haccp_year(app.HACCP_DIR, end, random.Random(SEED))
+        load_calibrations.append(calibrate())
+        started = time.perf_counter()
+        app.haccp_store.load()
+        load_times.append([time.perf_counter() - started])
+    results["haccp_load"] = summarize(load_times, load_calibrations)
+    fill_live_series(app.sensor_series, end, rng)
+    # Insertions découpées en tours ; la médiane par insertion écarte les quelques fsync lents
+    insert_times, insert_calibrations = store_batches(app, args.batches, end, rng, args.rounds)
+    results["batch_insert"] = summarize(insert_times, insert_calibrations)
+    app.read_sensors()
+    client = app.app.test_client()
+    client.post('/api/batch/start', json={"preset": "tempeh"})
+    print(f"Jeu de données : {entries} relevés HACCP, {args.batches} batchs, "
+        f"{len(app.sensor_series.raw['timestamps'])} points bruts ({workdir})")
+
+    page = client.get('/api/history?limit=50').get_json()
+    cursor = client.get(f"/api/history?limit=50&cursor={page['next_cursor']}").get_json()["next_cursor"]
+    batch_id = page["items"][len(page["items"]) // 2]["id"].replace("#", "%23")
+    month = end.strftime("%Y-%m")
+    cases = [
+        ("state", "/api/state"),
+        ("sensors_1h", "/api/sensors/history?interval=1h"),
+        ("sensors_24h", "/api/sensors/history?interval=24h"),
+        ("sensors_30d", "/api/sensors/history?interval=30d&points=500"),
+        ("sensors_30d_lttb", "/api/sensors/history?interval=30d&points=500&agg=lttb"),
+        ("history_page", "/api/history?limit=50"),
+        ("history_page3", f"/api/history?limit=50&cursor={cursor}"),
+        ("history_filtered", "/api/history?limit=50&preset=T&status=completed"),
+        ("history_batch", f"/api/history/{batch_id}"),
+        ("history_batch_1h", f"/api/history/{batch_id}?tier=1h"),
+        ("haccp_all", "/api/haccp"),
+        ("haccp_month", f"/api/haccp?month={month}"),
+        ("haccp_day", f"/api/haccp?day={end.strftime('%Y-%m-%d')}"),
+        ("analytics_preset", "/api/analytics?preset=T"),
+    ]
+    cases = [(name, url) for name, url in cases if not args.only or name in args.only]
+    for name, url in cases:
+        measure_round(client, url, 3)  # échauffement
+    # Tours entrelacés : une rafale de bruit de la machine touche tous les cas un peu plutôt qu'un seul beaucoup
+    rounds = {name: [] for name, _ in cases}
+    sizes = {}
+    for _ in range(args.rounds):
+        calibrations.append(calibrate())
+        for name, url in cases:
+            times, sizes[name] = measure_round(client, url, args.iterations)
+            rounds[name].append(times)
+    for name, _ in cases:
+        results[name] = summarize(rounds[name], calibrations, sizes[name])
+    client.post('/api/batch/stop', json={})
+    return results, statistics.median(calibrations + load_calibrations + insert_calibrations)
+
+def main():
+    parser = argparse.ArgumentParser(description="Bancs d'essai de l'API sur données synthétiques")
+    parser.add_argument("--batches", type=int, default=300)
+    parser.add_argument("--iterations", type=int, default=15, help="requêtes par cas et par tour")
+    parser.add_argument("--rounds", type=int, default=7, help="tours, chacun avec sa calibration")
+    parser.add_argument("--threshold", type=float, default=0.3, help="régression tolérée (0.3 = +30 %%)")
+    parser.add_argument("--save", action="store_true", help="enregistrer comme nouvelle référence")
+    parser.add_argument("--json", help="écrire les résultats dans ce fichier")
+    parser.add_argument("--only", nargs="*", help="limiter aux cas nommés")
+    args = parser.parse_args()
+
+    results, calibration = run(args)
+    report = {"calibration_ms": round(calibration * 1000, 3), "batches": args.batches,
+        "python": sys.version.split()[0], "cases": results}
+
+    baseline = None
+    if os.path.exists(BASELINE_FILE) and not args.save:
+        with open(BASELINE_FILE) as f:
+            baseline = json.load(f)
+    regressions = []
+    print(f"Calibration : {report['calibration_ms']} ms")
+    print(f"  {'cas':<18} {'médiane':>10} {'p95':>10} {'req/s':>8} {'octets':>9} {'relatif':>8} {'réf.':>8}")
+    for name, r in results.items():
+        ref_case = (baseline or {}).get("cases", {}).get(name, {})
+        ref = ref_case.get("relative")
+        flag = ""
+        threshold = args.threshold * (2 if r["median_ms"] < SMALL_CASE_MS else 1)
+        floor = max(NOISE_FLOOR, NOISE_SPREAD * max(r["spread"], ref_case.get("spread", 0)))
+        if ref and r["relative"] > ref * (1 + threshold) and r["relative"] - ref > floor:
+            flag = f"  RÉGRESSION +{(r['relative'] / ref - 1) * 100:.0f} %"
+            regressions.append(name)
+        print(f"  {name:<18} {r['median_ms']:>8.2f}ms {r.get('p95_ms', r['median_ms']):>8.2f}ms "
+            f"{r.get('req_s', ''):>8} {r.get('bytes', ''):>9} {r['relative']:>8.3f} {ref or '-':>8}{flag}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.save:
+        with open(BASELINE_FILE, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        print(f"Référence enregistrée dans {BASELINE_FILE}")
+    elif baseline is None:
+        print("Pas de référence : lancer avec --save pour en créer une")
+    if regressions:
+        print(f"{len(regressions)} régression(s) : {', '.join(regressions)}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+Protein Resequencer - Coordinateur multi-chambres
+Une instance sans matériel qui scrute plusieurs chambres (chacune son Pi et son app.py),
+garde leur dernier état en cache et sert un tableau de bord commun, l'historique des
+batchs fusionné et le registre HACCP fusionné. Chaque chambre a son propre thread et ses
+propres connexions : une chambre lente ou hors ligne ne retarde pas les autres.
+
+Chambres : PR_CHAMBERS="nom=url,nom=url" ou chambers.json {"nom": "url"}.
+
+Usage :
+    PR_FAKE_HARDWARE=1 PR_PORT=5001 PR_DATA_DIR=/tmp/chambre1 python3 app.py &
+    PR_FAKE_HARDWARE=1 PR_PORT=5002 PR_DATA_DIR=/tmp/chambre2 python3 app.py &
+    PR_CHAMBERS="A=http://localhost:5001,B=http://localhost:5002" python3 coordinator.py
+"""
+
+from flask import Flask, render_template, jsonify, request
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import quote, urlencode, urlsplit
+import base64
+import http.client
+import json
+import os
+import queue
+import threading
+import time
+
+app = Flask(__name__)
+
+CHAMBERS_FILE = "chambers.json"
+POLL_INTERVAL = float(os.environ.get("PR_POLL_INTERVAL", "2"))      # s entre deux /api/state
+REQUEST_TIMEOUT = float(os.environ.get("PR_CHAMBER_TIMEOUT", "3"))  # s par requête vers une chambre
+POOL_SIZE = 4  # connexions gardées ouvertes par chambre
+HISTORY_PAGE_DEFAULT = 50
+HISTORY_PAGE_MAX = 200
+
+class ChamberError(Exception):
+    pass
+
+class ChamberClient:
+    """Une chambre distante : connexions HTTP persistantes, dernier état connu, thread de scrutation."""
+
+    def __init__(self, name, url):
+        self.name = name
+        self.url = url.rstrip("/")
+        parts = urlsplit(self.url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.pool = queue.LifoQueue(maxsize=POOL_SIZE)
+        self.lock = threading.Lock()
+        self.state = None
+        self.updated = None  # epoch du dernier état reçu
+        self.latency = None
+        self.error = "jamais contactée"
+        self.thread = None
+
+    def request(self, path, params=None):
+        """GET JSON ; lève ChamberError (hors ligne, délai dépassé, réponse invalide)."""
+        if params:
+            path += "?" + urlencode({k: v for k, v in params.items() if v is not None})
+        try:
+            conn = self.pool.get_nowait()
+        except queue.Empty:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=REQUEST_TIMEOUT)
+        try:
+            conn.request("GET", path)
+            response = conn.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            raise ChamberError(f"{self.name}: {e or type(e).__name__}")
+        try:
+            self.pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+        if response.status == 404:
+            return None
+        if response.status != 200:
+            raise ChamberError(f"{self.name}: HTTP {response.status}")
+        try:
+            return json.loads(body)
+        except ValueError:
+            raise ChamberError(f"{self.name}: réponse illisible")
+
+    def poll(self):
+        while True:
+            started = time.monotonic()
+            try:
+                state = self.request("/api/state")
+                with self.lock:
+                    self.state = state
+                    self.updated = time.time()
+                    self.latency = time.monotonic() - started
+                    self.error = None
+            except ChamberError as e:
+                with self.lock:
+                    if self.error != str(e):
+                        print(f"Chambre {e}")
+                    self.error = str(e)
+            time.sleep(max(0.0, POLL_INTERVAL - (time.monotonic() - started)))
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.poll, name=f"chambre-{self.name}", daemon=True)
+            self.thread.start()
+
+    def status(self):
+        with self.lock:
+            age = time.time() - self.updated if self.updated else None
+            return {"name": self.name, "url": self.url, "online": self.error is None,
+                "age": round(age, 1) if age is not None else None,
+                "latency_ms": round(self.latency * 1000, 1) if self.latency is not None else None,
+                "error": self.error, "state": self.state}
+
+def load_chambers():
+    text = os.environ.get("PR_CHAMBERS")
+    if text:
+        pairs = [item.split("=", 1) for item in text.split(",") if "=" in item]
+        return {name.strip(): url.strip() for name, url in pairs}
+    if os.path.exists(CHAMBERS_FILE):
+        with open(CHAMBERS_FILE) as f:
+            return json.load(f)
+    return {}
+
+chambers = {name: ChamberClient(name, url) for name, url in load_chambers().items()}
+pool = ThreadPoolExecutor(max_workers=max(4, 2 * len(chambers)), thread_name_prefix="fan-out")
+
+def fan_out(call, targets=None):
+    """Exécute call(chambre) sur toutes les chambres en parallèle, en au plus REQUEST_TIMEOUT
+    (+ marge). Retourne ({nom: résultat}, {nom: erreur}) ; une chambre muette ne bloque pas.
+    Les chambres que la scrutation voit déjà hors ligne ne sont pas interrogées."""
+    targets = chambers if targets is None else targets
+    results, errors = {}, {}
+    futures = {}
+    for name in targets:
+        error = chambers[name].status()["error"]
+        if error:
+            errors[name] = error
+        else:
+            futures[pool.submit(call, chambers[name])] = name
+    done, pending = wait(futures, timeout=REQUEST_TIMEOUT + 1)
+    for future, name in futures.items():
+        if future in pending:
+            errors[name] = "délai dépassé"
+        elif future.exception() is not None:
+            errors[name] = str(future.exception())
+        else:
+            results[name] = future.result()
+    return results, errors
+
+# Même format que les curseurs d'app.py : sert aussi à reconstruire celui de chaque chambre
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+def decode_cursor(cursor):
+    return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+
+@app.route('/')
+def index():
+    return render_template('coordinator.html')
+
+@app.route('/api/chambers')
+def get_chambers():
+    """États en cache : aucune requête vers les chambres."""
+    return jsonify([c.status() for c in chambers.values()])
+
+@app.route('/api/history')
+def get_history():
+    """Historique fusionné, du plus récent au plus ancien, paginé par un curseur qui garde la
+    position de chaque chambre. Une chambre injoignable est signalée dans `errors` et reprise
+    à la même position à la page suivante s'il y en a une ; elle ne la provoque pas à elle seule
+    (sinon le bouton « Plus » renverrait indéfiniment des pages vides)."""
+    try:
+        limit = max(1, min(int(request.args.get('limit', HISTORY_PAGE_DEFAULT)), HISTORY_PAGE_MAX))
+        cursor = request.args.get('cursor')
+        positions = decode_cursor(cursor) if cursor else {name: None for name in chambers}
+    except (ValueError, TypeError):
+        return jsonify({"error": "Paramètres invalides"}), 400
+    active = [name for name, pos in positions.items() if name in chambers and pos != "fin"]
+    filters = {"preset": request.args.get('preset'), "status": request.args.get('status')}
+
+    def fetch(chamber):
+        pos = positions.get(chamber.name)
+        return chamber.request("/api/history", {"limit": limit, "cursor": encode_cursor(pos) if pos else None,
+            **filters})
+    pages, errors = fan_out(fetch, active)
+
+    merged = [{**item, "chamber": name} for name, page in pages.items() for item in page["items"]]
+    merged.sort(key=lambda item: (item["started_at"], item["id"]), reverse=True)
+    items = merged[:limit]
+    new_positions = dict(positions)
+    for name, page in pages.items():
+        taken = [item for item in items if item["chamber"] == name]
+        if len(taken) == len(page["items"]) and not page["next_cursor"]:
+            new_positions[name] = "fin"
+        elif taken:
+            new_positions[name] = [taken[-1]["started_at"], taken[-1]["id"]]
+    more = any(new_positions[name] != "fin" for name in pages)
+    return jsonify({"items": items, "next_cursor": encode_cursor(new_positions) if more else None, "errors": errors})
+
+@app.route('/api/history/<chamber>/<path:batch_id>')
+def get_history_item(chamber, batch_id):
+    if chamber not in chambers:
+        return jsonify({"error": "Chambre inconnue"}), 404
+    try:
+        record = chambers[chamber].request("/api/history/" + quote(batch_id, safe=""),
+            {"tier": request.args.get('tier')})
+    except ChamberError as e:
+        return jsonify({"error": str(e)}), 502
+    if record is None:
+        return jsonify({"error": "Non trouvé"}), 404
+    return jsonify({**record, "chamber": chamber})
+
+@app.route('/api/haccp')
+def get_haccp():
+    """Registre HACCP de toutes les chambres, trié par heure ; mêmes filtres ?day= / ?month=."""
+    params = {"day": request.args.get('day'), "month": request.args.get('month')}
+    registers, errors = fan_out(lambda chamber: chamber.request("/api/haccp", params))
+    entries = [{**e, "chamber": name} for name, register in registers.items() for e in register]
+    entries.sort(key=lambda e: (e["time"], e["chamber"]))
+    return jsonify({"entries": entries, "errors": errors})
+
+if __name__ == '__main__':
+    if not chambers:
+        print("Aucune chambre : définir PR_CHAMBERS ou chambers.json")
+    for chamber in chambers.values():
+        chamber.start()
+    port = int(os.environ.get("PR_PORT", "5100"))
+    try:
+        from waitress import serve
+        serve(app, host="0.0.0.0", port=port, threads=8)
+    except ImportError:
+        app.run(host="0.0.0.0", port=port, threaded=True, use_reloader=False)
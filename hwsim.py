@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+Protein Resequencer - Matériel simulé
+Arborescence 1-Wire factice, modèle thermique de la chambre et faux pilotes
+(relais, DS18B20, SHT40, MAX6675) pour développer, régler la régulation et
+mesurer les performances sans Raspberry Pi.
+
+Usage :
+    python3 hwsim.py /tmp/w1 [t1 t2 t3]
+    PR_W1_PATH=/tmp/w1 python3 app.py
+
+    PR_FAKE_HARDWARE=1 python3 app.py
+    PR_FAKE_HARDWARE=1 PR_FAKE_LATENCY="ds18b20=0.75,sht40=0.01" PR_FAKE_FAULTS="sht40=0.05,t2=0.01" python3 app.py
+
+    python3 hwsim.py simulate miso [--ambient 18] [--period 2]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+# Mêmes adresses que SENSOR_MAP dans app.py
+W1_DEVICES = {
+    "t1": "28-0000007020af",
+    "t2": "28-00000071b49c",
+    "t3": "28-00000073a825",
+}
+
+def w1_slave_content(temp, crc_ok=True):
+    """Contenu d'un fichier w1_slave tel que le produit le pilote w1_therm."""
+    raw = "72 01 4b 46 7f ff 0e 10 57"
+    return f"{raw} : crc=57 {'YES' if crc_ok else 'NO'}\n{raw} t={int(round(temp * 1000))}\n"
+
+def make_w1_tree(root, temps=None):
+    """Crée un maître w1 avec therm_bulk_read et une sonde par entrée de W1_DEVICES."""
+    master = os.path.join(root, "w1_bus_master1")
+    os.makedirs(master, exist_ok=True)
+    with open(os.path.join(master, "therm_bulk_read"), "w") as f:
+        f.write("0\n")
+    set_w1_temps(root, temps or {"t1": 30.0, "t2": 30.0, "t3": 4.0})
+    return root
+
+def set_w1_temps(root, temps, crc_ok=True):
+    """Met à jour les températures des sondes ; None retire la sonde du bus."""
+    for label, temp in temps.items():
+        device_dir = os.path.join(root, W1_DEVICES[label])
+        path = os.path.join(device_dir, "w1_slave")
+        if temp is None:
+            if os.path.exists(path):
+                os.remove(path)
+                os.rmdir(device_dir)
+            continue
+        os.makedirs(device_dir, exist_ok=True)
+        with open(path, "w") as f:
+            f.write(w1_slave_content(temp, crc_ok))
+
+class ChamberModel:
+    """Chambre à paramètres localisés.
+
+    Air + charge : capacité thermique `heat_capacity` (J/K), pertes `loss` (W/K) vers l'ambiant.
+    La résistance (`heater_power` W) a sa propre inertie (`element_lag` s) et les sondes
+    un retard du premier ordre (`sensor_lag` s) : c'est ce qui provoque les dépassements.
+    L'humidité monte de `humidifier_rate` %/s humidificateur allumé et retombe vers
+    l'ambiant avec la constante `humidity_leak` s."""
+
+    def __init__(self, ambient=20.0, ambient_humidity=50.0, heat_capacity=15000.0, loss=1.5,
+            heater_power=100.0, element_lag=120.0, sensor_lag=30.0, humidifier_rate=0.05, humidity_leak=900.0):
+        self.ambient = ambient
+        self.ambient_humidity = ambient_humidity
+        self.heat_capacity = heat_capacity
+        self.loss = loss
+        self.heater_power = heater_power
+        self.element_lag = element_lag
+        self.sensor_lag = sensor_lag
+        self.humidifier_rate = humidifier_rate
+        self.humidity_leak = humidity_leak
+        self.temperature = ambient
+        self.measured = ambient
+        self.element = 0.0  # puissance effectivement transmise à l'air (W)
+        self.humidity = ambient_humidity
+
+    def step(self, dt, heater_on, humidifier_on):
+        target = self.heater_power if heater_on else 0.0
+        self.element += (target - self.element) * min(1.0, dt / self.element_lag)
+        self.temperature += (self.element - self.loss * (self.temperature - self.ambient)) / self.heat_capacity * dt
+        self.measured += (self.temperature - self.measured) * min(1.0, dt / self.sensor_lag)
+        self.humidity += (self.humidifier_rate if humidifier_on else 0.0) * dt
+        self.humidity -= (self.humidity - self.ambient_humidity) * min(1.0, dt / self.humidity_leak)
+        self.humidity = min(100.0, self.humidity)
+
+def parse_rates(text):
+    """"ds18b20=0.75,sht40=0.01" -> {"ds18b20": 0.75, "sht40": 0.01}"""
+    rates = {}
+    for item in filter(None, (text or "").split(",")):
+        name, _, value = item.partition("=")
+        rates[name.strip()] = float(value)
+    return rates
+
+class FakeRelay:
+    """Même interface que gpiozero.OutputDevice ; niveau bas = relais fermé, comme sur la carte."""
+
+    def __init__(self, hardware, name):
+        self.hardware = hardware
+        self.name = name
+
+    def on(self):
+        self.hardware.set_relay(self.name, False)
+
+    def off(self):
+        self.hardware.set_relay(self.name, True)
+
+class FakeMAX6675:
+    """Trame brute du MAX6675 ; une panne simule un thermocouple ouvert (bit D2)."""
+
+    def __init__(self, hardware):
+        self.hardware = hardware
+
+    def read_raw(self):
+        if self.hardware.io("max6675"):
+            return 0x4
+        return int(self.hardware.oven_temperature() / 0.25) << 3
+
+class FakeSHT4x:
+    """Même interface que adafruit_sht4x.SHT4x ; une panne lève OSError comme une erreur I2C."""
+    serial_number = 0x5E40F00D
+
+    def __init__(self, hardware):
+        self.hardware = hardware
+        self.mode = None
+
+    @property
+    def measurements(self):
+        if self.hardware.io("sht40"):
+            raise OSError("[Errno 121] Remote I/O error (simulée)")
+        temperature, humidity = self.hardware.chamber()
+        return temperature, humidity
+
+class FakeHardware:
+    """Matériel complet simulé pour app.py (PR_FAKE_HARDWARE=1).
+
+    Les relais pilotent un ChamberModel qui avance en temps réel ; les sondes le lisent.
+    `latency` (s) et `faults` (probabilité d'échec par lecture) sont donnés par capteur :
+    ds18b20 (conversion), t1/t2/t3 (sonde absente), sht40, max6675. Le tirage des pannes
+    est fait avec une graine fixe pour que les essais soient reproductibles."""
+
+    def __init__(self, w1_root, latency=None, faults=None, seed=0, model=None, fridge=4.0, oven=20.0):
+        self.w1_root = make_w1_tree(w1_root)
+        self.latency = latency or {}
+        self.faults = faults or {}
+        self.random = random.Random(seed)
+        self.model = model or ChamberModel()
+        self.fridge = fridge
+        self.oven = oven
+        self.lock = threading.Lock()
+        self.relays = {}
+        self.updated = time.monotonic()
+
+    @classmethod
+    def from_env(cls):
+        root = os.environ.get("PR_W1_PATH") or tempfile.mkdtemp(prefix="pr-w1-")
+        return cls(root, parse_rates(os.environ.get("PR_FAKE_LATENCY")), parse_rates(os.environ.get("PR_FAKE_FAULTS")),
+            int(os.environ.get("PR_FAKE_SEED", "0")))
+
+    def io(self, device):
+        """Attend la latence du capteur ; retourne True si cette lecture doit échouer."""
+        delay = self.latency.get(device, 0.0)
+        if delay:
+            time.sleep(delay)
+        with self.lock:
+            return self.random.random() < self.faults.get(device, 0.0)
+
+    def set_relay(self, name, on):
+        with self.lock:
+            self.advance()
+            self.relays[name] = on
+
+    def advance(self):
+        now = time.monotonic()
+        dt = now - self.updated
+        self.updated = now
+        if dt > 0:
+            self.model.step(dt, self.relays.get("heater", False), self.relays.get("humidifier", False))
+
+    def chamber(self):
+        with self.lock:
+            self.advance()
+            return round(self.model.measured, 2), round(self.model.humidity, 1)
+
+    def oven_temperature(self):
+        with self.lock:
+            return self.oven + self.random.uniform(-0.5, 0.5)
+
+    def refresh_w1(self):
+        """Conversion DS18B20 simulée : met à jour les fichiers w1_slave avant leur lecture."""
+        failed = self.io("ds18b20")
+        temperature, _ = self.chamber()
+        with self.lock:
+            # Bruit de mesure d'environ deux pas de 0,0625 °C : il reste visible après l'arrondi
+            # au dixième de read_w1_slave, comme sur une vraie sonde
+            noise = [self.random.uniform(-0.15, 0.15) for _ in range(3)]
+            temps = {"t1": temperature + noise[0], "t2": temperature + 0.3 + noise[1], "t3": self.fridge + noise[2]}
+            missing = {label for label in temps if self.random.random() < self.faults.get(label, 0.0)}
+        for label in temps:
+            set_w1_temps(self.w1_root, {label: None if label in missing else temps[label]}, crc_ok=not failed)
+
+    def relay(self, name):
+        return FakeRelay(self, name)
+
+    def max6675(self):
+        return FakeMAX6675(self)
+
+    def sht4x(self):
+        return FakeSHT4x(self)
+
+def import_app():
+    """Importe app.py sans toucher au vrai matériel ni au dossier courant : faux pilotes et
+    données (batches.db, migration de history.json, HACCP) dans un dossier temporaire."""
+    if "app" not in sys.modules:
+        workdir = tempfile.mkdtemp(prefix="pr-sim-")
+        os.environ["PR_FAKE_HARDWARE"] = "1"
+        os.environ["PR_DATA_DIR"] = workdir
+        os.environ["PR_W1_PATH"] = os.path.join(workdir, "w1")
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app
+    return app
+
+def simulate(steps, gains=None, model=None, period=2.0):
+    """Rejoue un profil complet avec le régulateur de app.py, en temps simulé.
+
+    Retourne une statistique par étape : dépassement, erreur après stabilisation,
+    temps dans ±0,5 °C, rapport cyclique et nombre de commutations du chauffage."""
+    app = import_app()
+    model = model or ChamberModel()
+    controller = app.ChamberController(gains)
+    now = 0.0
+    results = []
+    heater_on = humidifier_on = False
+    for step in steps:
+        end = now + step["duration"] * 3600
+        stats = {"name": step["name"], "temp": step["temp"], "humidity": step["humidity"], "max": -1e9,
+            "reached": None, "sq_error": 0.0, "settled_ticks": 0, "in_band": 0, "ticks": 0,
+            "heater_on": 0, "switches": 0}
+        while now < end:
+            outputs, _ = controller.update(step, model.measured, model.humidity, now)
+            if outputs["heater"] != heater_on:
+                stats["switches"] += 1
+            heater_on, humidifier_on = outputs["heater"], outputs["humidifier"]
+            model.step(period, heater_on, humidifier_on)
+            now += period
+            error = model.measured - step["temp"]
+            stats["ticks"] += 1
+            stats["heater_on"] += heater_on
+            stats["in_band"] += abs(error) <= 0.5
+            if stats["reached"] is None and abs(error) <= 0.5:
+                stats["reached"] = now - (end - step["duration"] * 3600)
+            if stats["reached"] is not None:
+                stats["max"] = max(stats["max"], model.measured)
+                stats["sq_error"] += error * error
+                stats["settled_ticks"] += 1
+        settled = stats.pop("settled_ticks")
+        results.append({"name": stats["name"], "setpoint": step["temp"],
+            "rise_min": round(stats["reached"] / 60, 1) if stats["reached"] is not None else None,
+            "overshoot": round(max(0.0, stats["max"] - step["temp"]), 2) if settled else None,
+            "rms_error": round((stats["sq_error"] / settled) ** 0.5, 3) if settled else None,
+            "in_band_pct": round(100 * stats["in_band"] / stats["ticks"], 1),
+            "heater_duty_pct": round(100 * stats["heater_on"] / stats["ticks"], 1),
+            "heater_switches": stats["switches"],
+            "final_humidity": round(model.humidity, 1)})
+    return results
+
+def run_simulation(args):
+    import time
+    app = import_app()
+    preset = app.SYSTEM_PRESETS.get(args.preset)
+    if preset is None:
+        print(f"Préréglage inconnu: {args.preset} ({', '.join(app.SYSTEM_PRESETS)})")
+        sys.exit(1)
+    started = time.perf_counter()
+    results = simulate(preset["steps"], preset.get("pid"), ChamberModel(ambient=args.ambient), args.period)
+    elapsed = time.perf_counter() - started
+    hours = sum(s["duration"] for s in preset["steps"])
+    print(f"{preset['name']} : {hours} h simulées en {elapsed:.1f} s")
+    for r in results:
+        print(f"  {r['name']:<20} consigne {r['setpoint']:>4}°C  montée {r['rise_min']} min  "
+            f"dépassement {r['overshoot']} °C  RMS {r['rms_error']} °C  dans ±0,5 °C {r['in_band_pct']} %  "
+            f"chauffe {r['heater_duty_pct']} %  commutations {r['heater_switches']}  HR {r['final_humidity']} %")
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "simulate":
+        parser = argparse.ArgumentParser(prog="hwsim.py simulate")
+        parser.add_argument("preset")
+        parser.add_argument("--ambient", type=float, default=20.0)
+        parser.add_argument("--period", type=float, default=2.0, help="période de régulation (s)")
+        run_simulation(parser.parse_args(sys.argv[2:]))
+        sys.exit(0)
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    values = [float(v) for v in sys.argv[2:5]]
+    temps = dict(zip(["t1", "t2", "t3"], values)) if values else None
+    make_w1_tree(sys.argv[1], temps)
+    print(f"Arborescence 1-Wire factice créée dans {sys.argv[1]}")
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Protein Resequencer - Test de charge
+Plusieurs clients interrogent le serveur en parallèle pendant qu'un client pilote un batch
+(étapes, événements) ; on mesure le débit et la latence, et on vérifie que chaque réponse
+de /api/state est un instantané cohérent (pas de lecture « déchirée »).
+
+Usage :
+    PR_W1_PATH=/tmp/w1 PR_SERVER=waitress python3 app.py &
+    python3 loadtest.py [--url http://localhost:5000] [--clients 8] [--duration 20] [--no-mutate]
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+ENDPOINTS = ["/api/state", "/api/state", "/api/state", "/api/sensors/history?interval=1h", "/api/presets"]
+
+# Profil de test : next-step est appelé jusqu'à la dernière étape, les événements continuent ensuite
+MUTATE_STEPS = [{"name": f"Charge {i}", "temp": 30, "humidity": 70, "duration": 1, "ventilation": "off"}
+    for i in range(50)]
+
+def request_json(url, data=None):
+    body = None if data is None else json.dumps(data).encode()
+    req = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"} if body else {})
+    with urllib.request.urlopen(req, timeout=10) as resp:
+        return json.loads(resp.read())
+
+def check_state(s, last):
+    """Invariants d'un instantané ; retourne la liste des anomalies."""
+    problems = []
+    batch = s.get("batch")
+    if (batch is None) != (s.get("mode") == "idle"):
+        problems.append(f"mode {s.get('mode')} incohérent avec le batch")
+    if batch:
+        idx = batch["current_step_index"]
+        if not 0 <= idx < len(batch["steps"]) or batch["current_step"] != batch["steps"][idx]:
+            problems.append(f"étape courante {idx} incohérente")
+    if last and s["timestamp"] < last:
+        problems.append(f"instantané plus ancien que le précédent ({s['timestamp']} < {last})")
+    return problems
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = 0
+        self.problems = []
+
+    def record(self, endpoint, latency):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(latency)
+
+    def fail(self, problem):
+        with self.lock:
+            self.problems.append(problem)
+
+def reader(base, stop, stats, offset):
+    last = None
+    i = offset
+    while not stop.is_set():
+        endpoint = ENDPOINTS[i % len(ENDPOINTS)]
+        i += 1
+        started = time.perf_counter()
+        try:
+            data = request_json(base + endpoint)
+        except (urllib.error.URLError, OSError, ValueError):
+            with stats.lock:
+                stats.errors += 1
+            continue
+        stats.record(endpoint.split("?")[0], time.perf_counter() - started)
+        if endpoint == "/api/state":
+            for problem in check_state(data, last):
+                stats.fail(problem)
+            last = data["timestamp"]
+
+def mutator(base, stop, stats):
+    request_json(base + "/api/batch/start", {"name": "Test de charge", "steps": MUTATE_STEPS, "code": "X"})
+    try:
+        step = 0
+        while not stop.is_set():
+            started = time.perf_counter()
+            if step < len(MUTATE_STEPS) - 1:
+                request_json(base + "/api/batch/next-step", {})
+                step += 1
+            request_json(base + "/api/batch/event", {"text": "charge"})
+            stats.record("(écritures)", time.perf_counter() - started)
+            time.sleep(0.05)
+    finally:
+        request_json(base + "/api/batch/stop", {"status": "failed"})
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def main():
+    parser = argparse.ArgumentParser(description="Test de charge de l'API")
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=20.0, help="durée (s)")
+    parser.add_argument("--no-mutate", action="store_true", help="lecture seule, sans batch de test")
+    args = parser.parse_args()
+    base = args.url.rstrip("/")
+    if not args.no_mutate and request_json(base + "/api/state")["batch"]:
+        print("Un batch est en cours : relancer avec --no-mutate pour ne pas l'interrompre")
+        sys.exit(1)
+
+    stats = Stats()
+    stop = threading.Event()
+    threads = [threading.Thread(target=reader, args=(base, stop, stats, i)) for i in range(args.clients)]
+    if not args.no_mutate:
+        threads.append(threading.Thread(target=mutator, args=(base, stop, stats)))
+    for t in threads:
+        t.start()
+    time.sleep(args.duration)
+    stop.set()
+    for t in threads:
+        t.join()
+
+    total = sum(len(v) for v in stats.latencies.values())
+    print(f"{args.clients} clients, {args.duration:.0f} s : {total} requêtes, {total / args.duration:.0f} req/s, "
+        f"{stats.errors} erreurs")
+    for endpoint, values in sorted(stats.latencies.items()):
+        print(f"  {endpoint:<24} {len(values):>6}  p50 {percentile(values, 0.5) * 1000:6.1f} ms  "
+            f"p95 {percentile(values, 0.95) * 1000:6.1f} ms  max {max(values) * 1000:6.1f} ms")
+    if stats.problems:
+        print(f"{len(stats.problems)} instantanés incohérents, par exemple : {stats.problems[0]}")
+        sys.exit(1)
+    print("Aucune lecture incohérente")
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,9 @@ pkill -f "chromium.*localhost:5000" 2>/dev/null
 
 sleep 1
 
-# Serveur Flask
+# Serveur : waitress par défaut (sudo apt install python3-waitress), cheroot ou
+# "dev" (Werkzeug + débogueur) ; PR_THREADS threads de requêtes
+export PR_SERVER=${PR_SERVER:-waitress}
 python3 app.py &
 SERVER_PID=$!
 